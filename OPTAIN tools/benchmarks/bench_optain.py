@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+    bench_optain.py
+    ---------------------
+    Date                 : October 2026
+    Copyright         : (C) 2026 by Enrico A. Chiaradia
+    Email                : enrico.chiaradia@unimi.it
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+Scaling benchmark of the OPTAIN tools on synthetic data.
+
+The polygon mosaics are Voronoi tessellations of random points where a share
+of the cells is cut into a sliver and a share is enlarged to overlap the
+neighbours. Links are random polylines and nodes are random points.
+Each tool runs through optain_cli.py in a new process: the run time of each
+phase and the peak resident memory are saved as json.
+
+usage:
+    python bench_optain.py --sizes 1000,10000 --output bench.json
+"""
+
+__author__ = 'Enrico A. Chiaradia'
+__date__ = 'October 2026'
+__copyright__ = '(C) 2026, Enrico A. Chiaradia'
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import shapely
+import geopandas as gpd
+
+# optain_cli.py is in the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# mean area of the cells of the mosaic in map units
+CELL_AREA = 10000.
+TOOLS = ['merge-small-features', 'clean-overlap', 'find-common-edges', 'join-nodes-links', 'join-links-landuse']
+
+
+def makeMosaic(nFeat, sliverShare, overlapShare, rng, crs='EPSG:3035'):
+    # voronoi cells of random points, about nFeat polygons
+    nPoints = max(int(nFeat / (1 + sliverShare)), 3)
+    side = np.sqrt(nPoints * CELL_AREA)
+    points = shapely.multipoints(rng.uniform(0, side, (nPoints, 2)))
+    extent = shapely.box(0, 0, side, side)
+    cells = shapely.get_parts(shapely.voronoi_polygons(points, extend_to=extent))
+    cells = shapely.intersection(cells, extent)
+
+    # cut a thin strip from some cells
+    sliverIdx = np.flatnonzero(rng.random(len(cells)) < sliverShare)
+    xmin, ymin, xmax, ymax = shapely.bounds(cells[sliverIdx]).T
+    strips = shapely.box(xmin, ymin, xmin + 0.05 * (xmax - xmin), ymax)
+    slivers = shapely.intersection(cells[sliverIdx], strips)
+    cells[sliverIdx] = shapely.difference(cells[sliverIdx], strips)
+    cells = np.concatenate([cells, slivers[~shapely.is_empty(slivers)]])
+
+    # enlarge some cells so that they overlap the neighbours
+    overlapIdx = np.flatnonzero(rng.random(len(cells)) < overlapShare)
+    cells[overlapIdx] = shapely.buffer(cells[overlapIdx], 0.02 * np.sqrt(CELL_AREA))
+
+    # single part polygons only
+    cells = shapely.get_geometry(cells, 0)
+    cells = cells[shapely.area(cells) > 0]
+
+    nCell = len(cells)
+    return gpd.GeoDataFrame({'name': ['p%s' % i for i in range(nCell)],
+                             'gis_id': np.arange(nCell),
+                             'group': rng.integers(0, 5, nCell),
+                             'phi': rng.random(nCell),
+                             'type': rng.choice(['urml', 'urld', 'agrl', 'frst'], nCell)},
+                            geometry=cells, crs=crs)
+
+
+def makeLinks(nFeat, side, rng, nVertex=5, crs='EPSG:3035'):
+    # random walks starting from random points
+    step = np.sqrt(CELL_AREA)
+    starts = rng.uniform(0, side, (nFeat, 1, 2))
+    coords = starts + np.cumsum(rng.normal(0, step, (nFeat, nVertex, 2)), axis=1)
+    coords[:, 0, :] = starts[:, 0, :]
+    lines = shapely.linestrings(coords)
+    return gpd.GeoDataFrame({'id': np.arange(nFeat), 'gis_id': np.arange(nFeat)}, geometry=lines, crs=crs)
+
+
+def makeNodes(nFeat, side, rng, crs='EPSG:3035'):
+    points = shapely.points(rng.uniform(0, side, (nFeat, 2)))
+    return gpd.GeoDataFrame({'id': np.arange(nFeat)}, geometry=points, crs=crs)
+
+
+def makeDataset(nFeat, dataDir, sliverShare, overlapShare, seed, fileExt):
+    # write the input layers of all the tools and return their paths
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(nFeat * CELL_AREA)
+    layers = {'mosaic': makeMosaic(nFeat, sliverShare, 0, rng),
+              'overlap': makeMosaic(nFeat, 0, overlapShare, rng),
+              'links': makeLinks(nFeat, side, rng),
+              'nodes': makeNodes(nFeat, side, rng)}
+
+    paths = {}
+    for name, gdf in layers.items():
+        paths[name] = os.path.join(dataDir, '%s_%s%s' % (name, nFeat, fileExt))
+        if fileExt == '.parquet':
+            gdf.to_parquet(paths[name])
+        else:
+            gdf.to_file(paths[name])
+
+    return paths
+
+
+def toolArgs(tool, paths, outPath):
+    # optain_cli.py arguments of each tool
+    if tool == 'merge-small-features':
+        return [tool, paths['mosaic'], outPath, '--area-lim', str(0.2 * CELL_AREA), '--name-fld', 'name',
+                '--group-fld', 'group', '--phi-fld', 'phi', '--w-factor', '2']
+    if tool == 'clean-overlap':
+        return [tool, paths['overlap'], outPath]
+    if tool == 'find-common-edges':
+        return [tool, paths['mosaic'], paths['mosaic'], outPath]
+    if tool == 'join-nodes-links':
+        return [tool, paths['nodes'], paths['links'], outPath]
+    return [tool, paths['mosaic'], paths['links'], outPath]
+
+
+def runTool(argv, queue):
+    # executed in a new process, so that the peak memory refers to a single run
+    import optain_cli
+    optain_cli.importLibs()
+    feedback = optain_cli.Feedback(quiet=True)
+
+    t0 = time.perf_counter()
+    result = optain_cli.runTool(optain_cli.buildParser().parse_args(argv), feedback)
+    queue.put({'total': time.perf_counter() - t0,
+               'phases': feedback.timings,
+               'n_output': len(result),
+               # kilobytes on Linux
+               'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scaling benchmark of the OPTAIN tools')
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help='comma separated number of features')
+    parser.add_argument('--tools', default=','.join(TOOLS), help='comma separated tools to run')
+    parser.add_argument('--sliver-share', type=float, default=0.1)
+    parser.add_argument('--overlap-share', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=['gpkg', 'parquet'], default='gpkg')
+    parser.add_argument('--data-dir', default=None, help='folder for the synthetic layers (temporary if not set)')
+    parser.add_argument('--output', default='bench_optain.json')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    tools = args.tools.split(',')
+    fileExt = '.' + args.format
+
+    report = {'commit': gitCommit(),
+              'python': platform.python_version(),
+              'shapely': shapely.__version__,
+              'geopandas': gpd.__version__,
+              'machine': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': []}
+
+    # spawn gives each run a clean process to measure the peak memory
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmpDir:
+        dataDir = args.data_dir or tmpDir
+        os.makedirs(dataDir, exist_ok=True)
+        for nFeat in sizes:
+            print('Generating %s features ...' % nFeat, file=sys.stderr)
+            paths = makeDataset(nFeat, dataDir, args.sliver_share, args.overlap_share, args.seed, fileExt)
+            for tool in tools:
+                outPath = os.path.join(tmpDir, '%s_%s%s' % (tool, nFeat, fileExt))
+                queue = ctx.Queue()
+                proc = ctx.Process(target=runTool, args=(toolArgs(tool, paths, outPath), queue))
+                proc.start()
+                proc.join()
+                if proc.exitcode != 0:
+                    result = {'error': 'exit code %s' % proc.exitcode}
+                else:
+                    result = queue.get()
+
+                result.update({'tool': tool, 'size': nFeat})
+                report['results'].append(result)
+                print('%s %s: %s' % (tool, nFeat, json.dumps(result)), file=sys.stderr)
+
+                # keep the partial report if a large run is interrupted
+                with open(args.output, 'w') as f:
+                    json.dump(report, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,25 +24,36 @@ __author__ = 'Enrico A. Chiaradia'
 __date__ = 'September 2022'
 __copyright__ = '(C) 2022, Enrico A. Chiaradia'
 
+import hashlib
 import os
 
-from PyQt5.QtCore import QCoreApplication
+from PyQt5.QtCore import QCoreApplication, QVariant
 from qgis import processing
 from qgis.PyQt.QtGui import QIcon
 
 from qgis.core import (QgsApplication,
+                       QgsCoordinateReferenceSystem,
+                       QgsCoordinateTransformContext,
                        QgsFeatureRequest,
                        QgsFeature,
                        QgsFeatureSink,
+                       QgsField,
+                       QgsFields,
                        QgsGeometry,
                        QgsProcessingAlgorithm,
                        QgsProcessingException,
                        QgsProcessingUtils,
-                       QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterEnum,
                        QgsProcessing,
                        QgsProcessingParameterFeatureSink, QgsVectorLayer, QgsProcessingParameterField,
                        QgsProcessingParameterNumber,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterString,
+                       QgsProviderRegistry,
+                       QgsRectangle,
+                       QgsSpatialIndex,
+                       QgsVectorFileWriter,
                        QgsWkbTypes)
 
 pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
@@ -51,7 +62,18 @@ pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
 class CleanOverlap(QgsProcessingAlgorithm):
     LAYER1 = 'LAYER1'
     LAYER2 = 'LAYER2'
+    METHOD = 'METHOD'
+    OWNER_RULE = 'OWNER_RULE'
+    PRIORITY_FLD = 'PRIORITY_FLD'
     OUTPUT = 'OUTPUT'
+    REPORT = 'REPORT'
+    PREVIOUS = 'PREVIOUS'
+    PREVIOUS_LAYER = 'PREVIOUS_LAYER'
+
+    # number of report features written with a single addFeatures call
+    REPORT_BATCH = 10000
+    # suffix of the table with the hash of each input feature, saved next to a geopackage output
+    HASH_SUFFIX = '_hash'
 
     def tr(self, string):
         """
@@ -77,17 +99,324 @@ class CleanOverlap(QgsProcessingAlgorithm):
     def __init__(self):
         super().__init__()
 
-    def flags(self):
-        return super().flags() | QgsProcessingAlgorithm.FlagNoThreading | QgsProcessingAlgorithm.FlagNotAvailableInStandaloneTool
-
     def initAlgorithm(self, config=None):
 
-        self.addParameter(QgsProcessingParameterVectorLayer(self.LAYER1,
-                                                            self.tr('Layer with overlap'), [QgsProcessing.TypeVectorPolygon]))
+        self.addParameter(QgsProcessingParameterFeatureSource(self.LAYER1,
+                                                              self.tr('Layer with overlap'), [QgsProcessing.TypeVectorPolygon]))
+
+        self.addParameter(QgsProcessingParameterEnum(self.METHOD, self.tr('Method'),
+                                                     [self.tr('Pairwise difference'),
+                                                      self.tr('Planar overlay')], False, 0))
+
+        self.addParameter(QgsProcessingParameterEnum(self.OWNER_RULE, self.tr('Owner of the overlaps (planar overlay)'),
+                                                     [self.tr('Earlier feature wins'),
+                                                      self.tr('Larger area'),
+                                                      self.tr('Highest priority value'),
+                                                      self.tr('Later feature wins (as pairwise difference)')], False, 3))
+
+        self.addParameter(QgsProcessingParameterField(self.PRIORITY_FLD, self.tr('Priority field'), None, self.LAYER1,
+                                                      QgsProcessingParameterField.Numeric, False, True))
 
+        self.addParameter(QgsProcessingParameterFile(self.PREVIOUS,
+                                                     self.tr('Previous output to update (pairwise difference only)'),
+                                                     QgsProcessingParameterFile.File, 'gpkg', None, True))
+
+        self.addParameter(QgsProcessingParameterString(self.PREVIOUS_LAYER,
+                                                       self.tr('Layer of the previous output (first layer if empty)'),
+                                                       None, False, True))
 
         self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Cleared'), QgsProcessing.TypeVectorLine))
 
+        self.addParameter(QgsProcessingParameterFeatureSink(self.REPORT, self.tr('Overlap report'),
+                                                            QgsProcessing.TypeVectorPolygon, None, True, False))
+
+    def findOverlapPairs(self, featSet, feedback, fidList=None):
+        # bulk self-join on an in-memory spatial index, pairList[fid] = overlapping features processed after fid
+        # each unordered pair is emitted once, from the feature that comes first in the processing order
+        # if fidList is set, only the pairs of these features are searched
+        if fidList is None:
+            fidList = list(featSet)
+
+        orderOf = {}
+        index = QgsSpatialIndex()
+        for fid, aFeat in featSet.items():
+            orderOf[fid] = len(orderOf)
+            index.addFeature(aFeat)
+
+        pairList = {}
+        nFeat = len(fidList)
+        processCount = 0
+        for fid in fidList:
+            if feedback.isCanceled():
+                break
+
+            processCount += 1
+            feedback.setProgress(100 * float(processCount) / nFeat)
+
+            geom = featSet[fid].geometry()
+            candList = [nFid for nFid in index.intersects(geom.boundingBox()) if orderOf[nFid] > orderOf[fid]]
+            if not candList:
+                pairList[fid] = []
+                continue
+
+            # use prepared geometries for faster intersection tests, one preparation for all the candidates
+            engine = QgsGeometry.createGeometryEngine(geom.constGet())
+            engine.prepareGeometry()
+            pairList[fid] = [nFid for nFid in sorted(candList, key=orderOf.get)
+                             if engine.intersects(featSet[nFid].geometry().constGet())]
+
+        return pairList
+
+    def featureHash(self, aFeat):
+        # hash of the geometry and of the attributes of an input feature
+        featHash = hashlib.sha1(bytes(aFeat.geometry().asWkb()))
+        featHash.update(repr(aFeat.attributes()).encode('utf-8'))
+        return featHash.hexdigest()
+
+    def hashTableUri(self, layerUri):
+        # geopackage path and name of the hash table of an output layer, (None, None) if it is not a geopackage
+        uriParts = QgsProviderRegistry.instance().decodeUri('ogr', layerUri)
+        path = uriParts.get('path', '')
+        if not path.lower().endswith('.gpkg'):
+            return None, None
+
+        layerName = uriParts.get('layerName') or os.path.splitext(os.path.basename(path))[0]
+        return path, layerName + self.HASH_SUFFIX
+
+    def readHashTable(self, path, tableName):
+        # hashList[src_fid] = [out_fid, hash, bounding box of the input feature], None if the table does not exist
+        hashLayer = QgsVectorLayer('%s|layername=%s' % (path, tableName), 'hash', 'ogr')
+        if not hashLayer.isValid():
+            return None
+
+        hashList = {}
+        for row in hashLayer.getFeatures():
+            hashList[row['src_fid']] = [row['out_fid'], row['geom_hash'],
+                                        QgsRectangle(row['xmin'], row['ymin'], row['xmax'], row['ymax'])]
+
+        return hashList
+
+    def writeHashTable(self, path, tableName, hashList):
+        # overwrite the hash table inside the output geopackage
+        hashFields = QgsFields()
+        hashFields.append(QgsField('src_fid', QVariant.LongLong))
+        hashFields.append(QgsField('out_fid', QVariant.LongLong))
+        hashFields.append(QgsField('geom_hash', QVariant.String))
+        for fldName in ['xmin', 'ymin', 'xmax', 'ymax']:
+            hashFields.append(QgsField(fldName, QVariant.Double))
+
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'GPKG'
+        options.layerName = tableName
+        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
+        writer = QgsVectorFileWriter.create(path, hashFields, QgsWkbTypes.NoGeometry, QgsCoordinateReferenceSystem(),
+                                            QgsCoordinateTransformContext(), options)
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            raise QgsProcessingException(self.tr('Could not write table %s: %s') % (tableName, writer.errorMessage()))
+
+        rowList = []
+        for srcFid, (outFid, featHash, bbox) in hashList.items():
+            row = QgsFeature(hashFields)
+            row.setAttributes([srcFid, outFid, featHash,
+                               bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()])
+            rowList.append(row)
+
+        writer.addFeatures(rowList, QgsFeatureSink.FastInsert)
+        del writer
+
+    def dropHashTable(self, destUri):
+        # remove the hash table of a previous pairwise run, it does not describe the new output
+        path, tableName = self.hashTableUri(destUri)
+        if path is None:
+            return
+
+        conn = QgsProviderRegistry.instance().providerMetadata('ogr').createConnection(path, {})
+        if conn.tableExists('', tableName):
+            conn.dropVectorTable('', tableName)
+
+    def saveHashTable(self, destUri, featSet, feedback):
+        # after a full run, link each input feature to the output feature written in the same order
+        path, tableName = self.hashTableUri(destUri)
+        if path is None:
+            return
+
+        outLayer = QgsVectorLayer(destUri, 'cleared', 'ogr')
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setNoAttributes()
+        outFidList = [aFeat.id() for aFeat in outLayer.getFeatures(request)]
+        if len(outFidList) != len(featSet):
+            feedback.pushInfo(self.tr('The output does not match the input, the hash table is not saved'))
+            return
+
+        hashList = {}
+        for (fid, aFeat), outFid in zip(featSet.items(), outFidList):
+            hashList[fid] = [outFid, self.featureHash(aFeat), aFeat.geometry().boundingBox()]
+
+        self.writeHashTable(path, tableName, hashList)
+
+    def findChangedFeatures(self, featSet, oldHashList):
+        # features to reprocess: the changed and new ones and the ones that intersect the old or
+        # the new bounding box of a changed or deleted feature
+        newHashList = {fid: self.featureHash(aFeat) for fid, aFeat in featSet.items()}
+        rectList = []
+        changedSet = set()
+        for fid, featHash in newHashList.items():
+            oldHash = oldHashList.get(fid)
+            if (oldHash is not None) and (oldHash[1] == featHash):
+                continue
+
+            changedSet.add(fid)
+            rectList.append(featSet[fid].geometry().boundingBox())
+            if oldHash is not None:
+                rectList.append(oldHash[2])
+
+        deletedList = [fid for fid in oldHashList if fid not in featSet]
+        rectList.extend([oldHashList[fid][2] for fid in deletedList])
+
+        index = QgsSpatialIndex()
+        for aFeat in featSet.values():
+            index.addFeature(aFeat)
+
+        processSet = set(changedSet)
+        for rect in rectList:
+            processSet.update(index.intersects(rect))
+
+        return newHashList, changedSet, deletedList, processSet
+
+    def patchLayer(self, prevLayer, srcFields, newFeatList, oldHashList, newHashList, deletedList, featSet,
+                   hashPath, hashTable):
+        # update the previous output with the reprocessed features and save the new hash table
+        prevFields = prevLayer.fields()
+        pkIdxList = prevLayer.primaryKeyAttributes()
+        fieldMap = {}
+        for idx, fld in enumerate(srcFields):
+            prevIdx = prevFields.indexOf(fld.name())
+            if prevIdx >= 0 and prevIdx not in pkIdxList:
+                fieldMap[idx] = prevIdx
+
+        geomMap = {}
+        attrMap = {}
+        addList = []
+        addFidList = []
+        for newFeat in newFeatList:
+            attributes = newFeat.attributes()
+            if newFeat.id() in oldHashList:
+                outFid = oldHashList[newFeat.id()][0]
+                geomMap[outFid] = newFeat.geometry()
+                attrMap[outFid] = {prevIdx: attributes[idx] for idx, prevIdx in fieldMap.items()}
+            else:
+                addFeat = QgsFeature(prevFields)
+                for idx, prevIdx in fieldMap.items():
+                    addFeat.setAttribute(prevIdx, attributes[idx])
+                addFeat.setGeometry(newFeat.geometry())
+                addList.append(addFeat)
+                addFidList.append(newFeat.id())
+
+        # the hash table is written only if all the changes are saved
+        provider = prevLayer.dataProvider()
+        ok = (not deletedList) or provider.deleteFeatures([oldHashList[fid][0] for fid in deletedList])
+        ok = ok and ((not geomMap) or provider.changeGeometryValues(geomMap))
+        ok = ok and ((not attrMap) or provider.changeAttributeValues(attrMap))
+        if ok and addList:
+            ok, addList = provider.addFeatures(addList)
+        if not ok:
+            raise QgsProcessingException(self.tr('Could not update %s: %s') %
+                                         (prevLayer.source(), '; '.join(provider.errors())))
+
+        # new hash table, added features get the id assigned by the provider
+        outFidList = {fid: oldHash[0] for fid, oldHash in oldHashList.items()}
+        outFidList.update({fid: addFeat.id() for fid, addFeat in zip(addFidList, addList)})
+        hashList = {}
+        for fid, aFeat in featSet.items():
+            hashList[fid] = [outFidList[fid], newHashList[fid], aFeat.geometry().boundingBox()]
+
+        self.writeHashTable(hashPath, hashTable, hashList)
+
+    def reportFields(self):
+        reportFields = QgsFields()
+        reportFields.append(QgsField('poly1', QVariant.LongLong))
+        reportFields.append(QgsField('poly2', QVariant.LongLong))
+        reportFields.append(QgsField('area', QVariant.Double))
+        reportFields.append(QgsField('centroid_x', QVariant.Double))
+        reportFields.append(QgsField('centroid_y', QVariant.Double))
+        return reportFields
+
+    def makeReportFeature(self, reportFields, fid1, fid2, iGeom):
+        centroid = iGeom.centroid().asPoint()
+        reportFeat = QgsFeature(reportFields)
+        reportFeat.setAttributes([fid1, fid2, iGeom.area(), centroid.x(), centroid.y()])
+        if QgsWkbTypes.flatType(iGeom.wkbType()) == QgsWkbTypes.GeometryCollection:
+            # keep only the polygon parts, the intersection can also contain lines and points
+            iGeom = QgsGeometry.collectGeometry([g for g in iGeom.asGeometryCollection()
+                                                 if g.type() == QgsWkbTypes.PolygonGeometry])
+        reportFeat.setGeometry(iGeom)
+        return reportFeat
+
+    def planarOverlay(self, featSet, ownerRule, priorityFld, feedback, overlapList=None):
+        # node all the boundaries, polygonize and give each face to one of the features that cover it
+        # return the new geometry of each feature
+        # if overlapList is set, (fid, owner fid, face) is added for each feature that loses a face
+        orderOf = {}
+        boundaryList = []
+        index = QgsSpatialIndex()
+        for fid, aFeat in featSet.items():
+            orderOf[fid] = len(orderOf)
+            boundaryList.append(QgsGeometry(aFeat.geometry().constGet().boundary()))
+            index.addFeature(aFeat)
+
+        feedback.pushInfo(self.tr('Noding %s boundaries ...') % len(boundaryList))
+        nodedGeom = QgsGeometry.unaryUnion(boundaryList)
+        faceList = QgsGeometry.polygonize([nodedGeom]).asGeometryCollection()
+        feedback.pushInfo(self.tr('Num. of faces: %s') % len(faceList))
+
+        # the largest key wins, ties go to the first processed feature
+        if ownerRule == 1:
+            ownerKey = lambda fid: (featSet[fid].geometry().area(), -orderOf[fid])
+        elif ownerRule == 2:
+            # NULL priorities are the lowest
+            priorityOf = {}
+            for fid, aFeat in featSet.items():
+                value = aFeat[priorityFld]
+                isNull = (value is None) or (isinstance(value, QVariant) and value.isNull())
+                priorityOf[fid] = float('-inf') if isNull else float(value)
+            ownerKey = lambda fid: (priorityOf[fid], -orderOf[fid])
+        elif ownerRule == 3:
+            # the pairwise difference cuts each feature with the following ones, so the last one keeps the overlap
+            ownerKey = lambda fid: orderOf[fid]
+        else:
+            ownerKey = lambda fid: -orderOf[fid]
+
+        faceOf = {fid: [] for fid in featSet}
+        nFace = len(faceList)
+        processCount = 0
+        for face in faceList:
+            if feedback.isCanceled():
+                break
+
+            processCount += 1
+            feedback.setProgress(100 * float(processCount) / nFace)
+
+            # faces that are not covered by any feature are gaps of the input
+            point = face.pointOnSurface()
+            ownerList = [fid for fid in index.intersects(point.boundingBox())
+                         if featSet[fid].geometry().contains(point)]
+            if ownerList:
+                ownerFid = max(ownerList, key=ownerKey)
+                faceOf[ownerFid].append(face)
+                if overlapList is not None:
+                    overlapList.extend([(fid, ownerFid, face) for fid in ownerList if fid != ownerFid])
+
+        newGeomSet = {}
+        for fid, aFaceList in faceOf.items():
+            if len(aFaceList) == 1:
+                newGeomSet[fid] = aFaceList[0]
+            elif aFaceList:
+                newGeomSet[fid] = QgsGeometry.unaryUnion(aFaceList)
+            else:
+                # completely covered by other features
+                newGeomSet[fid] = QgsGeometry()
+
+        return newGeomSet
+
     def name(self):
         return 'cleanoverlap'
 
@@ -95,67 +424,159 @@ class CleanOverlap(QgsProcessingAlgorithm):
         return self.tr('Clear operlapping features')
 
     def processAlgorithm(self, parameters, context, feedback):
-        layer1 = self.parameterAsVectorLayer(parameters, self.LAYER1, context)
-        # populate temporarily layer to use spatial selection
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
-                                               layer1.fields(), QgsWkbTypes.MultiPolygon, layer1.sourceCrs())
-
-        if sink is None:
-            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
-
-        feedback.pushInfo('poly1;poly2;geom;area')
-
-        nFeat = layer1.featureCount()
+        layer1 = self.parameterAsSource(parameters, self.LAYER1, context)
+        if layer1 is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.LAYER1))
+        method = self.parameterAsEnum(parameters, self.METHOD, context)
+        ownerRule = self.parameterAsEnum(parameters, self.OWNER_RULE, context)
+        priorityFld = self.parameterAsFields(parameters, self.PRIORITY_FLD, context)
+        if ownerRule == 2 and not priorityFld:
+            raise QgsProcessingException(self.tr('The priority field is required by the selected owner rule'))
+
+        # incremental mode: the previous output is updated in place and no new layer is created
+        # the file is opened by a private layer, so that no project layer is changed from the processing thread
+        prevUri = self.parameterAsFile(parameters, self.PREVIOUS, context)
+        prevLayerName = self.parameterAsString(parameters, self.PREVIOUS_LAYER, context)
+        prevLayer = None
+        oldHashList = None
+        if prevUri:
+            if prevLayerName:
+                prevUri = '%s|layername=%s' % (prevUri, prevLayerName)
+            prevLayer = QgsVectorLayer(prevUri, 'previous', 'ogr')
+            if not prevLayer.isValid():
+                raise QgsProcessingException(self.tr('Could not open %s') % prevUri)
+            if method == 1:
+                raise QgsProcessingException(self.tr('The previous output can be updated only by the pairwise difference'))
+
+            hashPath, hashTable = self.hashTableUri(prevLayer.source())
+            if hashPath is not None:
+                oldHashList = self.readHashTable(hashPath, hashTable)
+            if oldHashList is None:
+                raise QgsProcessingException(
+                    self.tr('%s has no hash table, run a full cleaning to a geopackage first') % prevLayer.source())
+
+            sink = None
+            dest_id = prevLayer.source()
+        else:
+            # populate temporarily layer to use spatial selection
+            (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                                   layer1.fields(), QgsWkbTypes.MultiPolygon, layer1.sourceCrs())
+
+            if sink is None:
+                raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+        # optional table of the overlaps, written in batches
+        reportFields = self.reportFields()
+        (reportSink, report_id) = self.parameterAsSink(parameters, self.REPORT, context,
+                                                       reportFields, QgsWkbTypes.MultiPolygon, layer1.sourceCrs())
+        reportList = []
+        nOverlap = 0
+        overlapArea = 0.
+
+        # load all the features, the processing order is the one of the source
+        featSet = {aFeat.id(): aFeat for aFeat in layer1.getFeatures()}
+
+        if method == 1:
+            overlapList = []
+            newGeomSet = self.planarOverlay(featSet, ownerRule, priorityFld[0] if priorityFld else None, feedback,
+                                            overlapList)
+            newFeatList = []
+            for fid, poly1 in featSet.items():
+                newFeat = QgsFeature(poly1)
+                newFeat.setGeometry(newGeomSet.get(fid, QgsGeometry()))
+                newFeatList.append(newFeat)
+
+            sink.addFeatures(newFeatList, QgsFeatureSink.FastInsert)
+            del sink
+            # only the pairwise difference can update its output, so no hash table is saved
+            self.dropHashTable(dest_id)
+
+            for fid, ownerFid, face in overlapList:
+                nOverlap += 1
+                overlapArea += face.area()
+                if reportSink is not None:
+                    reportList.append(self.makeReportFeature(reportFields, fid, ownerFid, face))
+                    if len(reportList) >= self.REPORT_BATCH:
+                        reportSink.addFeatures(reportList, QgsFeatureSink.FastInsert)
+                        reportList = []
+
+            if reportSink is not None:
+                reportSink.addFeatures(reportList, QgsFeatureSink.FastInsert)
+                del reportSink
+
+            feedback.pushInfo(self.tr('Num. of overlaps: %s, total area: %s') % (nOverlap, overlapArea))
+            return {self.OUTPUT: dest_id, self.REPORT: report_id}
+
+        processFidList = list(featSet)
+        if oldHashList is not None:
+            newHashList, changedSet, deletedList, processSet = self.findChangedFeatures(featSet, oldHashList)
+            processFidList = [fid for fid in featSet if fid in processSet]
+            feedback.pushInfo(self.tr('Changed features: %s, deleted features: %s, features to reprocess: %s') %
+                              (len(changedSet), len(deletedList), len(processFidList)))
+            newFeatList = []
+
+        feedback.pushInfo(self.tr('Searching overlapping features ...'))
+        pairList = self.findOverlapPairs(featSet, feedback, processFidList)
+
+        nFeat = len(processFidList)
         processCount = 0
-        # loop in layer 2
-        justProcessed = []
-        for poly1 in layer1.getFeatures():
+        for fid in processFidList:
 
             if feedback.isCanceled():
                 break
 
+            poly1 = featSet[fid]
+
             processCount += 1
             feedback.setProgress(100 * float(processCount) / nFeat)
 
-            justProcessed.append(poly1.id())
             geom1 = poly1.geometry()
             newGeom1 = QgsGeometry(geom1)
 
-            bbox = geom1.boundingBox()
-            fit = layer1.getFeatures(
-                QgsFeatureRequest().setFilterRect(bbox))
-
-            # use prepared geometries for faster intersection tests
-            engine = QgsGeometry.createGeometryEngine(geom1.constGet())
-            engine.prepareGeometry()
-
-            # for each polygon in layer 2, get touching polygons in layer 1
-            for poly2 in fit:
-                if (poly2.id() != poly1.id()) and\
-                        (poly2.id() not in justProcessed):
-
-                    geom2 = poly2.geometry()
-                    # calculate intersection
-                    if engine.intersects(geom2.constGet()):
+            # polygons intersecting poly1 that are not processed yet
+            for nFid in pairList.get(fid, []):
+                poly2 = featSet[nFid]
+                geom2 = poly2.geometry()
 
-                        # calculate intersection
-                        iGeom = geom1.intersection(geom2)
+                # calculate intersection
+                iGeom = geom1.intersection(geom2)
 
-                        if iGeom.area()>0:
-                            feedback.pushInfo('%s;%s;%s;%s' % (poly1.id(), poly2.id(),iGeom.centroid().asWkt(3),iGeom.area()))
+                if iGeom.area()>0:
+                    nOverlap += 1
+                    overlapArea += iGeom.area()
+                    if reportSink is not None:
+                        reportList.append(self.makeReportFeature(reportFields, poly1.id(), poly2.id(), iGeom))
+                        if len(reportList) >= self.REPORT_BATCH:
+                            reportSink.addFeatures(reportList, QgsFeatureSink.FastInsert)
+                            reportList = []
 
-                        if not iGeom:
-                            continue
+                if not iGeom:
+                    continue
 
-                        # cut current geometry with intersection
-                        newGeom1 = newGeom1.difference(geom2)
+                # cut current geometry with intersection
+                newGeom1 = newGeom1.difference(geom2)
 
             # save processed feature in sink
             newFeat = QgsFeature(poly1)
             newFeat.setGeometry(newGeom1)
+            if sink is None:
+                newFeatList.append(newFeat)
+                continue
+
             # add to sink
             sink.addFeature(newFeat, QgsFeatureSink.FastInsert)
 
-        del sink
+        if sink is not None:
+            del sink
+            if not feedback.isCanceled():
+                self.saveHashTable(dest_id, featSet, feedback)
+        elif not feedback.isCanceled():
+            self.patchLayer(prevLayer, layer1.fields(), newFeatList, oldHashList, newHashList, deletedList, featSet,
+                            hashPath, hashTable)
+
+        if reportSink is not None:
+            reportSink.addFeatures(reportList, QgsFeatureSink.FastInsert)
+            del reportSink
 
-        return {self.OUTPUT: dest_id}
+        feedback.pushInfo(self.tr('Num. of overlaps: %s, total area: %s') % (nOverlap, overlapArea))
+        return {self.OUTPUT: dest_id, self.REPORT: report_id}
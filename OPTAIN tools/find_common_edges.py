@@ -24,9 +24,11 @@ __author__ = 'Enrico A. Chiaradia'
 __date__ = 'September 2022'
 __copyright__ = '(C) 2022, Enrico A. Chiaradia'
 
+import hashlib
 import os
 
-from PyQt5.QtCore import QCoreApplication
+import numpy as np
+from PyQt5.QtCore import QCoreApplication, QVariant
 from qgis import processing
 from qgis.PyQt.QtGui import QIcon
 
@@ -34,15 +36,20 @@ from qgis.core import (QgsApplication,
                        QgsFeatureRequest,
                        QgsFeature,
                        QgsFeatureSink,
+                       QgsField,
+                       QgsFields,
                        QgsGeometry,
+                       QgsPointXY,
                        QgsProcessingAlgorithm,
                        QgsProcessingException,
                        QgsProcessingUtils,
-                       QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterEnum,
                        QgsProcessing,
                        QgsProcessingParameterFeatureSink, QgsVectorLayer, QgsProcessingParameterField,
                        QgsProcessingParameterNumber,
+                       QgsProcessingParameterFileDestination,
+                       QgsSpatialIndex,
                        QgsWkbTypes)
 
 pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
@@ -51,7 +58,12 @@ pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
 class FindCommonEdges(QgsProcessingAlgorithm):
     LAYER1 = 'LAYER1'
     LAYER2 = 'LAYER2'
+    METHOD = 'METHOD'
+    SNAP = 'SNAP'
     OUTPUT = 'OUTPUT'
+    ADJACENCY = 'ADJACENCY'
+    # how shared_length is measured, checked by the tools that read the table
+    ADJACENCY_MEASURE = 'intersection_length'
 
     def tr(self, string):
         """
@@ -77,19 +89,26 @@ class FindCommonEdges(QgsProcessingAlgorithm):
     def __init__(self):
         super().__init__()
 
-    def flags(self):
-        return super().flags() | QgsProcessingAlgorithm.FlagNoThreading | QgsProcessingAlgorithm.FlagNotAvailableInStandaloneTool
-
     def initAlgorithm(self, config=None):
 
-        self.addParameter(QgsProcessingParameterVectorLayer(self.LAYER1,
-                                                            self.tr('First layer'), [QgsProcessing.TypeVectorPolygon]))
+        self.addParameter(QgsProcessingParameterFeatureSource(self.LAYER1,
+                                                              self.tr('First layer'), [QgsProcessing.TypeVectorPolygon]))
+
+        self.addParameter(QgsProcessingParameterFeatureSource(self.LAYER2,
+                                                              self.tr('Second layer'), [QgsProcessing.TypeVectorPolygon]))
 
-        self.addParameter(QgsProcessingParameterVectorLayer(self.LAYER2,
-                                                            self.tr('Second layer'), [QgsProcessing.TypeVectorPolygon]))
+        self.addParameter(QgsProcessingParameterEnum(self.METHOD, self.tr('Method'),
+                                                     [self.tr('Ring difference'),
+                                                      self.tr('Shared arcs (topology)')], False, 0))
+
+        self.addParameter(QgsProcessingParameterNumber(self.SNAP, self.tr('Snapping tolerance (shared arcs)'),
+                                                       QgsProcessingParameterNumber.Double, 0., False, 0.))
 
         self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Merged'), QgsProcessing.TypeVectorLine))
 
+        self.addParameter(QgsProcessingParameterFileDestination(self.ADJACENCY, self.tr('Adjacency table'),
+                                                                self.tr('NumPy arrays (*.npz)'), None, True, False))
+
     def name(self):
         return 'findcommonedges'
 
@@ -111,9 +130,190 @@ class FindCommonEdges(QgsProcessingAlgorithm):
 
         return commonEdge
 
+    def getRings(self, geom, snap):
+        # all the rings of all the parts, exterior rings clockwise and holes counter-clockwise
+        # so that the polygon is always on the right side
+        if snap > 0:
+            geom = geom.snappedToGrid(snap, snap)
+
+        geom = geom.forcePolygonClockwise()
+        if geom.isMultipart():
+            polygonList = geom.asMultiPolygon()
+        else:
+            polygonList = [geom.asPolygon()]
+
+        return [ring for polygon in polygonList for ring in polygon]
+
+    def segmentKey(self, p1, p2):
+        # the same key for both directions of the segment
+        p1 = (p1.x(), p1.y())
+        p2 = (p2.x(), p2.y())
+        return (p1, p2) if p1 <= p2 else (p2, p1)
+
+    def buildSegmentIndex(self, layer, snap, feedback):
+        # one pass on all the boundary segments, segmentIndex[segment key] = list of feature ids
+        segmentIndex = {}
+        for aFeat in layer.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([])):
+            if feedback.isCanceled():
+                break
+
+            for ring in self.getRings(aFeat.geometry(), snap):
+                for i in range(len(ring) - 1):
+                    segmentIndex.setdefault(self.segmentKey(ring[i], ring[i + 1]), []).append(aFeat.id())
+
+        return segmentIndex
+
+    def chainSegments(self, segmentList):
+        # segments are in ring order, a segment that starts at the end of the previous one continues the arc
+        # (QgsGeometry.mergeLines could reverse the arc and put the polygon of layer 1 on the left side)
+        chainList = []
+        for p1, p2 in segmentList:
+            if chainList and chainList[-1][-1] == p1:
+                chainList[-1].append(p2)
+            else:
+                chainList.append([p1, p2])
+
+        # the arc that crosses the first vertex of the ring
+        if len(chainList) > 1 and chainList[-1][-1] == chainList[0][0]:
+            chainList[0] = chainList.pop() + chainList[0][1:]
+
+        return chainList
+
+    def findSharedArcs(self, layer1, layer2, snap, sameLayer, feedback):
+        # shared arcs between the polygons of layer 1 (right side) and of layer 2 (left side)
+        # segments are matched by their end points, so adjacent polygons must share the vertices
+        segmentIndex = self.buildSegmentIndex(layer2, snap, feedback)
+
+        # pairSegments[(fid1, fid2)] = shared segments, in the direction of the ring of fid1
+        pairSegments = {}
+        nFeat = layer1.featureCount()
+        processCount = 0
+        for aFeat in layer1.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([])):
+            if feedback.isCanceled():
+                break
+
+            processCount += 1
+            feedback.setProgress(100 * float(processCount) / nFeat)
+
+            fid1 = aFeat.id()
+            for ring in self.getRings(aFeat.geometry(), snap):
+                for i in range(len(ring) - 1):
+                    for fid2 in segmentIndex.get(self.segmentKey(ring[i], ring[i + 1]), []):
+                        # with the same layer, each pair once
+                        if sameLayer and fid2 <= fid1:
+                            continue
+
+                        pairSegments.setdefault((fid1, fid2), []).append([QgsPointXY(ring[i]), QgsPointXY(ring[i + 1])])
+
+        # join the segments of each pair into arcs, keeping the direction of the ring
+        arcList = []
+        for (fid1, fid2), segmentList in pairSegments.items():
+            arcList.extend([(fid1, fid2, QgsGeometry.fromPolylineXY(chain)) for chain in self.chainSegments(segmentList)])
+
+        return arcList
+
+    def layerHash(self, featList):
+        # content hash of the feature ids and geometries, the same of MergeSmallFeatures.layerHash
+        featHash = hashlib.sha1()
+        for fid, wkb in sorted((aFeat.id(), bytes(aFeat.geometry().asWkb())) for aFeat in featList):
+            featHash.update(str(fid).encode('utf-8'))
+            featHash.update(wkb)
+
+        return featHash.hexdigest()
+
+    def buildAdjacency(self, layer1, layer2, sameLayer, feedback):
+        # lengthOf[(fid1, fid2)] = length of the intersection of two touching polygons,
+        # the same measure of MergeSmallFeatures.buildAdjacencyGraph, so that the table gives the same merge
+        geoms2 = {}
+        index = QgsSpatialIndex()
+        for aFeat in layer2.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([])):
+            geoms2[aFeat.id()] = aFeat.geometry()
+            index.addFeature(aFeat)
+
+        lengthOf = {}
+        nFeat = layer1.featureCount()
+        processCount = 0
+        for aFeat in layer1.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([])):
+            if feedback.isCanceled():
+                break
+
+            processCount += 1
+            feedback.setProgress(100 * float(processCount) / nFeat)
+
+            geom = aFeat.geometry()
+            engine = QgsGeometry.createGeometryEngine(geom.constGet())
+            engine.prepareGeometry()
+            for nFid in index.intersects(geom.boundingBox()):
+                if sameLayer and nFid == aFeat.id():
+                    continue
+
+                nGeom = geoms2[nFid]
+                if not engine.intersects(nGeom.constGet()):
+                    continue
+
+                iGeom = geom.intersection(nGeom)
+                if iGeom:
+                    lengthOf[(aFeat.id(), nFid)] = iGeom.length()
+
+        return lengthOf
+
+    def saveAdjacency(self, fileName, lengthOf, hashA, hashB):
+        # sparse adjacency in CSR format: the neighbours of row_fid[i] are col_fid[indptr[i]:indptr[i + 1]]
+        # with the same layer the table is symmetric
+        pairList = sorted(lengthOf)
+        rowFid = np.array(sorted(set(fid1 for fid1, fid2 in pairList)), dtype=np.int64)
+        rowList = np.array([fid1 for fid1, fid2 in pairList], dtype=np.int64)
+        indptr = np.searchsorted(rowList, rowFid, 'left')
+        indptr = np.append(indptr, len(pairList)).astype(np.int64)
+        np.savez(fileName,
+                 hash_a=np.array(hashA), hash_b=np.array(hashB), measure=np.array(self.ADJACENCY_MEASURE),
+                 row_fid=rowFid, indptr=indptr,
+                 col_fid=np.array([fid2 for fid1, fid2 in pairList], dtype=np.int64),
+                 shared_length=np.array([lengthOf[pair] for pair in pairList], dtype=np.float64))
+
     def processAlgorithm(self, parameters, context, feedback):
-        layer1 = self.parameterAsVectorLayer(parameters, self.LAYER1, context)
-        layer2 = self.parameterAsVectorLayer(parameters, self.LAYER2, context)
+        layer1 = self.parameterAsSource(parameters, self.LAYER1, context)
+        layer2 = self.parameterAsSource(parameters, self.LAYER2, context)
+        if layer1 is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.LAYER1))
+        if layer2 is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.LAYER2))
+
+        method = self.parameterAsEnum(parameters, self.METHOD, context)
+        snap = self.parameterAsDouble(parameters, self.SNAP, context)
+        adjacencyFile = self.parameterAsFileOutput(parameters, self.ADJACENCY, context)
+        sameLayer = str(parameters[self.LAYER1]) == str(parameters[self.LAYER2])
+        if adjacencyFile:
+            # keyed by the content of the inputs, so that other tools can check it is up to date
+            # the table does not depend on the method and on the snapping tolerance
+            feedback.pushInfo(self.tr('Building adjacency table ...'))
+            hashA = self.layerHash(layer1.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([])))
+            hashB = hashA if sameLayer else self.layerHash(layer2.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([])))
+            self.saveAdjacency(adjacencyFile, self.buildAdjacency(layer1, layer2, sameLayer, feedback), hashA, hashB)
+
+        if method == 1:
+            arcList = self.findSharedArcs(layer1, layer2, snap, sameLayer, feedback)
+            feedback.pushInfo(self.tr('Num. of shared arcs: %s') % len(arcList))
+            arcFields = QgsFields()
+            arcFields.append(QgsField('left_fid', QVariant.LongLong))
+            arcFields.append(QgsField('right_fid', QVariant.LongLong))
+            arcFields.append(QgsField('length', QVariant.Double))
+            (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                                   arcFields, QgsWkbTypes.LineString, layer2.sourceCrs())
+            if sink is None:
+                raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+            arcFeatList = []
+            for fid1, fid2, arcGeom in arcList:
+                arcFeat = QgsFeature(arcFields)
+                arcFeat.setAttributes([fid2, fid1, arcGeom.length()])
+                arcFeat.setGeometry(arcGeom)
+                arcFeatList.append(arcFeat)
+
+            sink.addFeatures(arcFeatList, QgsFeatureSink.FastInsert)
+            del sink
+            return {self.OUTPUT: dest_id, self.ADJACENCY: adjacencyFile}
+
         # populate temporarily layer to use spatial selection
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
                                                layer2.fields(), QgsWkbTypes.LineString, layer2.sourceCrs())
@@ -148,4 +348,4 @@ class FindCommonEdges(QgsProcessingAlgorithm):
 
         del sink
 
-        return {self.OUTPUT: dest_id}
+        return {self.OUTPUT: dest_id, self.ADJACENCY: adjacencyFile}
@@ -38,12 +38,12 @@ from qgis.core import (QgsApplication,
                        QgsProcessingAlgorithm,
                        QgsProcessingException,
                        QgsProcessingUtils,
-                       QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterEnum,
                        QgsProcessing,
                        QgsProcessingParameterFeatureSink, QgsVectorLayer, QgsProcessingParameterField,
-                       QgsProcessingParameterNumber,
-                       QgsWkbTypes, QgsField, QgsSpatialIndex, QgsPointXY)
+                       QgsProcessingParameterNumber, QgsProcessingParameterString,
+                       QgsWkbTypes, QgsField, QgsSpatialIndex, QgsPointXY, QgsPoint, QgsRectangle)
 
 pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
 
@@ -51,6 +51,10 @@ pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
 class FindCommonEdges(QgsProcessingAlgorithm):
     LULAYER = 'LULAYER'
     LINKLAYER = 'LINKLAYER'
+    TYPE_FLD = 'TYPE_FLD'
+    TYPE_VALUES = 'TYPE_VALUES'
+    LU_ID_FLD = 'LU_ID_FLD'
+    LINK_ID_FLD = 'LINK_ID_FLD'
     OUTPUT = 'OUTPUT'
 
     def tr(self, string):
@@ -63,8 +67,8 @@ class FindCommonEdges(QgsProcessingAlgorithm):
         return FindCommonEdges()
 
     def icon(self):
-        self.alg_dir = os.path.dirname(__file__)
-        icon = QIcon(os.path.join(self.alg_dir, 'joinLinkLanduse.svg'))
+        alg_dir = os.path.dirname(__file__)
+        icon = QIcon(os.path.join(alg_dir, 'joinLinkLanduse.svg'))
         return icon
 
     def group(self):
@@ -76,16 +80,25 @@ class FindCommonEdges(QgsProcessingAlgorithm):
     def __init__(self):
         super().__init__()
 
-    def flags(self):
-        return super().flags() | QgsProcessingAlgorithm.FlagNoThreading | QgsProcessingAlgorithm.FlagNotAvailableInStandaloneTool
-
     def initAlgorithm(self, config=None):
 
-        self.addParameter(QgsProcessingParameterVectorLayer(self.LULAYER,
-                                                            self.tr('Land use layer'), [QgsProcessing.TypeVectorPolygon]))
+        self.addParameter(QgsProcessingParameterFeatureSource(self.LULAYER,
+                                                              self.tr('Land use layer'), [QgsProcessing.TypeVectorPolygon]))
+
+        self.addParameter(QgsProcessingParameterFeatureSource(self.LINKLAYER,
+                                                              self.tr('Link layer'), [QgsProcessing.TypeVectorLine]))
+
+        self.addParameter(QgsProcessingParameterField(self.TYPE_FLD, self.tr('Land use type field'), 'type', self.LULAYER,
+                                                      QgsProcessingParameterField.Any))
 
-        self.addParameter(QgsProcessingParameterVectorLayer(self.LINKLAYER,
-                                                            self.tr('Link layer'), [QgsProcessing.TypeVectorLine]))
+        self.addParameter(QgsProcessingParameterString(self.TYPE_VALUES,
+                                                       self.tr('Land use types (separated by semicolon)'), 'urml;urld'))
+
+        self.addParameter(QgsProcessingParameterField(self.LU_ID_FLD, self.tr('Land use id field'), 'gis_id',
+                                                      self.LULAYER, QgsProcessingParameterField.Any))
+
+        self.addParameter(QgsProcessingParameterField(self.LINK_ID_FLD, self.tr('Link id field'), 'gis_id',
+                                                      self.LINKLAYER, QgsProcessingParameterField.Any))
 
         self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Joined'), QgsProcessing.TypeVectorPolygon))
 
@@ -101,50 +114,84 @@ class FindCommonEdges(QgsProcessingAlgorithm):
     					<b>Parameters:</b>
     					Land use layer: the layer of the land use [LULAYER]
     					Link layer: the layer with the network [LINKLAYER]
+    					Land use type field: the field with the land use class [TYPE_FLD]
+    					Land use types: the classes that get a link, separated by semicolon [TYPE_VALUES]
+    					Land use id field: the id of the land use, used in the log [LU_ID_FLD]
+    					Link id field: the link id copied to dest_cha [LINK_ID_FLD]
     					<b>Note:</b>
     					none.  
     					"""
 
         return self.tr(helpStr)
 
-    def lineStartsInPoly(self, line, poly, link_lay,err = 0.001):
-        # compute the rings
-        #print('poly', poly['id'])
-        #print('line', line['id'])
-        # get starting vertex
-        start_vtx = line.geometry().vertexAt(0)
-        #print('start_vtx', start_vtx)
-        # check if inside the poly
-        if not poly.geometry().contains(QgsGeometry().fromPointXY(QgsPointXY(start_vtx.x(),start_vtx.y()))):
-            #print('Point not in poly')
-            return False
-
-        # check if  line is connect with some other_lines
-        point_bbox = start_vtx.boundingBox().buffered(err)
-        #print('point_bbox', point_bbox.asWktPolygon())
-        other_lines = link_lay.getFeatures(
-            QgsFeatureRequest().setFilterRect(point_bbox))  # .setSubsetOfAttributes(['id']))
-        # count selected
-        sel_lines = 0
-        for other_line in other_lines:
-            #print('other_line',other_line['id'])
-            sel_lines+=1
-            #if other_line.geometry().intersects(point_bbox):
-            #    print('Other lines connection')
-            #    return False
-
-        # more than one line is connected to the point
-        if sel_lines>1: return False
-
-        return True
+    def snapKey(self, x, y, err):
+        # cell of the tolerance grid
+        return (int(x // err), int(y // err))
+
+    def buildEndpointDegree(self, link_lay, err, feedback):
+        # one pass on the links: number of links with the start or the end vertex in each cell of the grid
+        degreeMap = {}
+        for link in link_lay.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            if feedback.isCanceled():
+                break
+
+            linkGeom = link.geometry()
+            if linkGeom.isEmpty():
+                continue
+
+            # a closed link is counted once
+            keySet = set()
+            for vtx in [linkGeom.vertexAt(0), linkGeom.vertexAt(linkGeom.constGet().nCoordinates() - 1)]:
+                keySet.add(self.snapKey(vtx.x(), vtx.y(), err))
+
+            for key in keySet:
+                degreeMap[key] = degreeMap.get(key, 0) + 1
+
+        return degreeMap
+
+    def endpointDegree(self, degreeMap, x, y, err):
+        # links that start or end within the tolerance, the eight cells around are included
+        col, row = self.snapKey(x, y, err)
+        return sum(degreeMap.get((col + i, row + j), 0) for i in (-1, 0, 1) for j in (-1, 0, 1))
+
+    def buildStartIndex(self, link_lay, linkIdFld, degreeMap, err, feedback):
+        # start vertices of the links that are not connected to other links, indexed by their position
+        startList = []
+        linkIdList = []
+        index = QgsSpatialIndex()
+        for link in link_lay.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([linkIdFld], link_lay.fields())):
+            if feedback.isCanceled():
+                break
+
+            linkGeom = link.geometry()
+            if linkGeom.isEmpty():
+                continue
+
+            start_vtx = linkGeom.vertexAt(0)
+            # more than one line is connected to the point
+            if self.endpointDegree(degreeMap, start_vtx.x(), start_vtx.y(), err) > 1:
+                continue
+
+            index.addFeature(len(startList), QgsRectangle(start_vtx.x(), start_vtx.y(), start_vtx.x(), start_vtx.y()))
+            startList.append(QgsPoint(start_vtx.x(), start_vtx.y()))
+            linkIdList.append(link[linkIdFld])
+
+        return index, startList, linkIdList
 
     def processAlgorithm(self, parameters, context, feedback):
-        lu_lay = self.parameterAsVectorLayer(parameters, self.LULAYER, context)
-        link_lay = self.parameterAsVectorLayer(parameters, self.LINKLAYER, context)
+        lu_lay = self.parameterAsSource(parameters, self.LULAYER, context)
+        link_lay = self.parameterAsSource(parameters, self.LINKLAYER, context)
+        if lu_lay is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.LULAYER))
+        if link_lay is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.LINKLAYER))
         #nameFld = self.parameterAsFields(parameters, self.NAME_FLD, context)[0]
         #buf_dist = self.parameterAsDouble(parameters, self.W_FACTOR, context)
         # populate temporarily layer to use spatial selection
-        newField = QgsField('dest_cha',QVariant.Int)
+        # dest_cha has the type of the link id field, that can be text
+        linkIdFld = self.parameterAsFields(parameters, self.LINK_ID_FLD, context)[0]
+        newField = QgsField(link_lay.fields().field(linkIdFld))
+        newField.setName('dest_cha')
 
         newFields = lu_lay.fields()
         newFields.append(newField)
@@ -155,6 +202,15 @@ class FindCommonEdges(QgsProcessingAlgorithm):
         if sink is None:
             raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
 
+        typeFld = self.parameterAsFields(parameters, self.TYPE_FLD, context)[0]
+        typeList = [t.strip() for t in self.parameterAsString(parameters, self.TYPE_VALUES, context).split(';') if t.strip()]
+        luIdFld = self.parameterAsFields(parameters, self.LU_ID_FLD, context)[0]
+
+        # connections of the network and start vertices, computed once
+        err = 0.001
+        degreeMap = self.buildEndpointDegree(link_lay, err, feedback)
+        index, startList, linkIdList = self.buildStartIndex(link_lay, linkIdFld, degreeMap, err, feedback)
+
         nLus = lu_lay.featureCount()
         processCount = 0
 
@@ -166,18 +222,19 @@ class FindCommonEdges(QgsProcessingAlgorithm):
             feedback.setProgress(100 * float(processCount) / nLus)
             dest_id = None
 
-            if lu['type'] in ['urml','urld']:
-                bbox = lu.geometry().boundingBox()
-                link_sel_list = link_lay.getFeatures(
-                    QgsFeatureRequest().setFilterRect(bbox))  # .setSubsetOfAttributes(['id']))
+            if lu[typeFld] in typeList:
+                luGeom = lu.geometry()
+                startIdList = index.intersects(luGeom.boundingBox())
 
                 dest_id_list = []
-                for link_sel in link_sel_list:
-                    # check if link starts inside the polygon
-                    if self.lineStartsInPoly(link_sel,lu,link_lay): dest_id_list.append(link_sel['gis_id'])
+                if startIdList:
+                    # one prepared geometry for all the start vertices inside the bounding box
+                    engine = QgsGeometry.createGeometryEngine(luGeom.constGet())
+                    engine.prepareGeometry()
+                    dest_id_list = [linkIdList[i] for i in sorted(startIdList) if engine.contains(startList[i])]
 
                 if len(dest_id_list)>1:
-                    feedback.pushInfo('More than one segments start inside the polygon %s'%(lu['gis_id']))
+                    feedback.pushInfo('More than one segments start inside the polygon %s'%(lu[luIdFld]))
                 elif len(dest_id_list)==1:
                     dest_id = dest_id_list[0]
                 else:
@@ -26,6 +26,7 @@ __copyright__ = '(C) 2022, Enrico A. Chiaradia'
 
 import os
 
+import numpy as np
 from PyQt5.QtCore import QCoreApplication, QVariant
 from qgis import processing
 from qgis.PyQt.QtGui import QIcon
@@ -38,12 +39,16 @@ from qgis.core import (QgsApplication,
                        QgsProcessingAlgorithm,
                        QgsProcessingException,
                        QgsProcessingUtils,
-                       QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterEnum,
                        QgsProcessing,
                        QgsProcessingParameterFeatureSink, QgsVectorLayer, QgsProcessingParameterField,
                        QgsProcessingParameterNumber,
-                       QgsWkbTypes, QgsField)
+                       QgsProcessingParameterBoolean,
+                       QgsPointXY,
+                       QgsRectangle,
+                       QgsSpatialIndex,
+                       QgsWkbTypes, QgsField, QgsFields)
 
 pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
 
@@ -51,7 +56,12 @@ pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
 class FindCommonEdges(QgsProcessingAlgorithm):
     NODELAYER = 'NODELAYER'
     LINKLAYER = 'LINKLAYER'
+    LINK_ID_FLD = 'LINK_ID_FLD'
+    MAX_DIST = 'MAX_DIST'
+    TOP_K = 'TOP_K'
+    SEGMENT_INDEX = 'SEGMENT_INDEX'
     OUTPUT = 'OUTPUT'
+    TOP_K_OUTPUT = 'TOP_K_OUTPUT'
 
     def tr(self, string):
         """
@@ -77,19 +87,32 @@ class FindCommonEdges(QgsProcessingAlgorithm):
     def __init__(self):
         super().__init__()
 
-    def flags(self):
-        return super().flags() | QgsProcessingAlgorithm.FlagNoThreading | QgsProcessingAlgorithm.FlagNotAvailableInStandaloneTool
-
     def initAlgorithm(self, config=None):
 
-        self.addParameter(QgsProcessingParameterVectorLayer(self.NODELAYER,
-                                                            self.tr('First layer'), [QgsProcessing.TypeVectorPoint]))
+        self.addParameter(QgsProcessingParameterFeatureSource(self.NODELAYER,
+                                                              self.tr('First layer'), [QgsProcessing.TypeVectorPoint]))
+
+        self.addParameter(QgsProcessingParameterFeatureSource(self.LINKLAYER,
+                                                              self.tr('Second layer'), [QgsProcessing.TypeVectorLine]))
+
+        self.addParameter(QgsProcessingParameterField(self.LINK_ID_FLD, self.tr('Link id field'), 'id', self.LINKLAYER,
+                                                      QgsProcessingParameterField.Any))
+
+        self.addParameter(QgsProcessingParameterNumber(self.MAX_DIST, self.tr('Maximum distance (0 = no limit)'),
+                                                       QgsProcessingParameterNumber.Double, 1000., False, 0.))
+
+        self.addParameter(QgsProcessingParameterNumber(self.TOP_K, self.tr('Number of nearest links (table)'),
+                                                       QgsProcessingParameterNumber.Integer, 1, False, 1))
 
-        self.addParameter(QgsProcessingParameterVectorLayer(self.LINKLAYER,
-                                                            self.tr('Second layer'), [QgsProcessing.TypeVectorLine]))
+        self.addParameter(QgsProcessingParameterBoolean(self.SEGMENT_INDEX,
+                                                        self.tr('Index the single segments of the links (long links)'),
+                                                        False))
 
         self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Joined'), QgsProcessing.TypeVectorPoint))
 
+        self.addParameter(QgsProcessingParameterFeatureSink(self.TOP_K_OUTPUT, self.tr('Nearest links'),
+                                                            QgsProcessing.TypeVector, None, True, False))
+
     def name(self):
         return 'joinnodeslinks'
 
@@ -111,18 +134,136 @@ class FindCommonEdges(QgsProcessingAlgorithm):
 
         return commonEdge
 
+    def findNearestLinks(self, index, nodeGeom, topK, maxDist):
+        # the topK nearest links as (distance, link fid, snapped x, snapped y, position along the link)
+        # ties at the last place are kept
+        nearList = []
+        for fid in index.nearestNeighbor(nodeGeom, topK, maxDist):
+            linkGeom = index.geometry(fid)
+            snapGeom = linkGeom.nearestPoint(nodeGeom)
+            snapPoint = snapGeom.asPoint()
+            nearList.append((linkGeom.distance(nodeGeom), fid, snapPoint.x(), snapPoint.y(),
+                             linkGeom.lineLocatePoint(snapGeom)))
+
+        nearList.sort()
+        if maxDist > 0:
+            nearList = [near for near in nearList if near[0] <= maxDist]
+
+        return nearList
+
+    def buildSegmentIndex(self, link_lay, linkIdFld):
+        # explode the links into segments, the arrays hold start point, direction, squared length,
+        # position of the start point along the link and link fid of each segment
+        linkIdOf = {}
+        segList = []
+        for l in link_lay.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([linkIdFld], link_lay.fields())):
+            linkIdOf[l.id()] = l[linkIdFld]
+            linkGeom = l.geometry()
+            if linkGeom.isMultipart():
+                partList = linkGeom.asMultiPolyline()
+            else:
+                partList = [linkGeom.asPolyline()]
+
+            linkPos = 0.
+            for part in partList:
+                for i in range(len(part) - 1):
+                    segLength = part[i].distance(part[i + 1])
+                    segList.append((part[i].x(), part[i].y(), part[i + 1].x(), part[i + 1].y(), linkPos, l.id()))
+                    linkPos += segLength
+
+        segArray = np.array(segList, dtype=np.float64).reshape(-1, 6)
+        segments = {'x': segArray[:, 0], 'y': segArray[:, 1],
+                    'dx': segArray[:, 2] - segArray[:, 0], 'dy': segArray[:, 3] - segArray[:, 1],
+                    'pos': segArray[:, 4], 'fid': segArray[:, 5].astype(np.int64)}
+        segments['l2'] = segments['dx'] ** 2 + segments['dy'] ** 2
+
+        index = QgsSpatialIndex()
+        xMin = np.minimum(segArray[:, 0], segArray[:, 2]).tolist()
+        yMin = np.minimum(segArray[:, 1], segArray[:, 3]).tolist()
+        xMax = np.maximum(segArray[:, 0], segArray[:, 2]).tolist()
+        yMax = np.maximum(segArray[:, 1], segArray[:, 3]).tolist()
+        for segId in range(len(segList)):
+            index.addFeature(segId, QgsRectangle(xMin[segId], yMin[segId], xMax[segId], yMax[segId]))
+
+        return index, segments, linkIdOf
+
+    def segmentDistances(self, segments, segIdList, x, y):
+        # vectorized distance from the point to the segments, with the snapped points and their position
+        segIdx = np.array(segIdList, dtype=np.int64)
+        dx = segments['dx'][segIdx]
+        dy = segments['dy'][segIdx]
+        l2 = segments['l2'][segIdx]
+        x0 = segments['x'][segIdx]
+        y0 = segments['y'][segIdx]
+        t = np.zeros(len(segIdx))
+        nonZero = l2 > 0
+        t[nonZero] = np.clip(((x - x0[nonZero]) * dx[nonZero] + (y - y0[nonZero]) * dy[nonZero]) / l2[nonZero], 0, 1)
+        snapX = x0 + t * dx
+        snapY = y0 + t * dy
+        dist = np.hypot(x - snapX, y - snapY)
+        return dist, segments['fid'][segIdx], snapX, snapY, segments['pos'][segIdx] + t * np.sqrt(l2)
+
+    def findNearestSegments(self, index, segments, nodeGeom, topK, maxDist):
+        # same result of findNearestLinks from the index of the segments
+        point = nodeGeom.centroid().asPoint()
+        x, y = point.x(), point.y()
+
+        # nearest bounding boxes until topK links are found, their distance limits the search
+        nSeg = 4 * topK
+        while True:
+            segIdList = index.nearestNeighbor(point, nSeg, maxDist)
+            if not segIdList:
+                return []
+
+            dist, linkFid, snapX, snapY, linkPos = self.segmentDistances(segments, segIdList, x, y)
+            linkDist = {}
+            for d, fid in zip(dist.tolist(), linkFid.tolist()):
+                linkDist[fid] = min(d, linkDist.get(fid, d))
+
+            if (len(linkDist) >= topK) or (len(segIdList) < nSeg):
+                break
+
+            nSeg *= 4
+
+        # all the segments that can be closer than the k-th link
+        searchDist = sorted(linkDist.values())[min(topK, len(linkDist)) - 1]
+        segIdList = index.intersects(QgsRectangle(x - searchDist, y - searchDist, x + searchDist, y + searchDist))
+        dist, linkFid, snapX, snapY, linkPos = self.segmentDistances(segments, segIdList, x, y)
+
+        # the closest segment of each link
+        nearOf = {}
+        for near in zip(dist.tolist(), linkFid.tolist(), snapX.tolist(), snapY.tolist(), linkPos.tolist()):
+            if (near[1] not in nearOf) or (near[0] < nearOf[near[1]][0]):
+                nearOf[near[1]] = near
+
+        nearList = sorted(nearOf.values())
+        if maxDist > 0:
+            nearList = [near for near in nearList if near[0] <= maxDist]
+
+        return nearList[:topK]
+
     def processAlgorithm(self, parameters, context, feedback):
-        node_lay = self.parameterAsVectorLayer(parameters, self.NODELAYER, context)
-        link_lay = self.parameterAsVectorLayer(parameters, self.LINKLAYER, context)
+        node_lay = self.parameterAsSource(parameters, self.NODELAYER, context)
+        link_lay = self.parameterAsSource(parameters, self.LINKLAYER, context)
+        if node_lay is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.NODELAYER))
+        if link_lay is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.LINKLAYER))
         #nameFld = self.parameterAsFields(parameters, self.NAME_FLD, context)[0]
-        #buf_dist = self.parameterAsDouble(parameters, self.W_FACTOR, context)
+        linkIdFld = self.parameterAsFields(parameters, self.LINK_ID_FLD, context)[0]
+        maxDist = self.parameterAsDouble(parameters, self.MAX_DIST, context)
+        topK = self.parameterAsInt(parameters, self.TOP_K, context)
+        segmentIndex = self.parameterAsBoolean(parameters, self.SEGMENT_INDEX, context)
         # populate temporarily layer to use spatial selection
-        newField = QgsField('link_id',QVariant.Int)
-
-        buf_dist = 1000
+        # link_id has the type of the link id field, that can be text
+        newField = QgsField(link_lay.fields().field(linkIdFld))
+        newField.setName('link_id')
 
         newFields = node_lay.fields()
         newFields.append(newField)
+        # distance, snapped point and its position along the closest link
+        for fldName in ['link_dist', 'snap_x', 'snap_y', 'link_pos']:
+            newFields.append(QgsField(fldName, QVariant.Double))
 
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
                                                newFields, node_lay.wkbType(), node_lay.sourceCrs())
@@ -130,8 +271,34 @@ class FindCommonEdges(QgsProcessingAlgorithm):
         if sink is None:
             raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
 
+        # optional table with the topK nearest links of each node
+        nearFields = QgsFields()
+        nearFields.append(QgsField('node_fid', QVariant.LongLong))
+        nearFields.append(QgsField(newField))
+        nearFields.append(QgsField('distance', QVariant.Double))
+        nearFields.append(QgsField('rank', QVariant.Int))
+        nearFields.append(QgsField('link_pos', QVariant.Double))
+        (nearSink, near_id) = self.parameterAsSink(parameters, self.TOP_K_OUTPUT, context,
+                                                   nearFields, QgsWkbTypes.NoGeometry, node_lay.sourceCrs())
+        if nearSink is None:
+            topK = 1
+
+        if segmentIndex:
+            # in-memory index of the segments, distances are computed with numpy
+            index, segments, linkIdOf = self.buildSegmentIndex(link_lay, linkIdFld)
+            feedback.pushInfo(self.tr('Num. of link segments: %s') % len(segments['fid']))
+        else:
+            # in-memory index of the links, distances are computed on the stored geometries
+            linkIdOf = {}
+            index = QgsSpatialIndex(QgsSpatialIndex.FlagStoreFeatureGeometries)
+            for l in link_lay.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([linkIdFld], link_lay.fields())):
+                index.addFeature(l)
+                linkIdOf[l.id()] = l[linkIdFld]
+
         nFeat = node_lay.featureCount()
         processCount = 0
+        nMissing = 0
+        nearList = []
         # loop in layer 2
         for node in node_lay.getFeatures():
 
@@ -141,29 +308,40 @@ class FindCommonEdges(QgsProcessingAlgorithm):
             processCount += 1
             feedback.setProgress(100 * float(processCount) / nFeat)
 
-            bbox = node.geometry().buffer(buf_dist,10).boundingBox()
-            link_sel = link_lay.getFeatures(
-                QgsFeatureRequest().setFilterRect(bbox))#.setSubsetOfAttributes(['id']))
-
-            # for each polygon in layer 2, get touching polygons in layer 1
-            max_dist = 2*buf_dist
             closestLinkId = None
-            for l in link_sel:
-                # calculate distance
-                dist = node.geometry().distance(l.geometry())
-                #print('dist',dist)
-                if dist<max_dist:
-                    max_dist = dist
-                    closestLinkId = l['id']
-                    #print('closestLinkId', closestLinkId)
-
-            print('closestLinkId', closestLinkId, 'distance',max_dist)
+            closestValues = [None, None, None, None]
+            nodeGeom = node.geometry()
+            if nodeGeom.isEmpty():
+                nearestList = []
+            elif segmentIndex:
+                nearestList = self.findNearestSegments(index, segments, nodeGeom, topK, maxDist)
+            else:
+                nearestList = self.findNearestLinks(index, nodeGeom, topK, maxDist)
+
+            if nearestList:
+                dist, linkFid, snapX, snapY, linkPos = nearestList[0]
+                closestLinkId = linkIdOf[linkFid]
+                closestValues = [dist, snapX, snapY, linkPos]
+            else:
+                nMissing += 1
+
+            if nearSink is not None:
+                for rank, (dist, linkFid, snapX, snapY, linkPos) in enumerate(nearestList[:topK]):
+                    nearFeat = QgsFeature(nearFields)
+                    nearFeat.setAttributes([node.id(), linkIdOf[linkFid], dist, rank + 1, linkPos])
+                    nearList.append(nearFeat)
+
             newFeat = QgsFeature(newFields)
-            newFeat.setGeometry(node.geometry())
-            newFeat.setAttributes(node.attributes()+[closestLinkId])
+            newFeat.setGeometry(nodeGeom)
+            newFeat.setAttributes(node.attributes()+[closestLinkId]+closestValues)
             # add to sink
             sink.addFeature(newFeat, QgsFeatureSink.FastInsert)
 
         del sink
 
-        return {self.OUTPUT: dest_id}
+        if nearSink is not None:
+            nearSink.addFeatures(nearList, QgsFeatureSink.FastInsert)
+            del nearSink
+
+        feedback.pushInfo(self.tr('Num. of nodes without link: %s') % nMissing)
+        return {self.OUTPUT: dest_id, self.TOP_K_OUTPUT: near_id}
@@ -23,9 +23,13 @@ __author__ = 'Enrico A. Chiaradia'
 __date__ = 'September 2022'
 __copyright__ = '(C) 2022, Enrico A. Chiaradia'
 
+import hashlib
+import heapq
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from PyQt5.QtCore import QCoreApplication
+import numpy as np
+from PyQt5.QtCore import QCoreApplication, QVariant
 from qgis import processing
 from qgis.PyQt.QtGui import QIcon
 
@@ -37,11 +41,13 @@ from qgis.core import (QgsApplication,
                        QgsProcessingAlgorithm,
                        QgsProcessingException,
                        QgsProcessingUtils,
-                       QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterEnum,
                        QgsProcessing,
                        QgsProcessingParameterFeatureSink, QgsVectorLayer, QgsProcessingParameterField,
-                       QgsProcessingParameterNumber, QgsWkbTypes)
+                       QgsProcessingParameterNumber, QgsWkbTypes, QgsSpatialIndex,
+                       QgsProcessingParameterBoolean, QgsProcessingParameterString, QgsProcessingParameterFile,
+                       QgsField, QgsFields)
 
 pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
 
@@ -54,6 +60,16 @@ class MergeSmallFeatures(QgsProcessingAlgorithm):
     AREA_LIM = 'AREA_LIM'
     W_FACTOR = 'W_FACTOR'
     TOLL = 'TOLL'
+    IN_MEMORY = 'IN_MEMORY'
+    N_WORKERS = 'N_WORKERS'
+    DETERMINISTIC = 'DETERMINISTIC'
+    AREA_SWEEP = 'AREA_SWEEP'
+    MERGE_TABLE = 'MERGE_TABLE'
+    DEFER_UNION = 'DEFER_UNION'
+    AVG_FLDS = 'AVG_FLDS'
+    ADJACENCY = 'ADJACENCY'
+    # the same of FindCommonEdges.ADJACENCY_MEASURE
+    ADJACENCY_MEASURE = 'intersection_length'
     OUTPUT = 'OUTPUT'
 
     def tr(self, string):
@@ -80,13 +96,10 @@ class MergeSmallFeatures(QgsProcessingAlgorithm):
     def __init__(self):
         super().__init__()
 
-    def flags(self):
-        return super().flags() | QgsProcessingAlgorithm.FlagNoThreading | QgsProcessingAlgorithm.FlagNotAvailableInStandaloneTool
-
     def initAlgorithm(self, config=None):
 
-        self.addParameter(QgsProcessingParameterVectorLayer(self.INPUT,
-                                                            self.tr('Input layer'), [QgsProcessing.TypeVectorPolygon]))
+        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT,
+                                                              self.tr('Input layer'), [QgsProcessing.TypeVectorPolygon]))
 
         self.addParameter(
             QgsProcessingParameterNumber(self.AREA_LIM, self.tr('Area limits'), QgsProcessingParameterNumber.Double))
@@ -103,10 +116,35 @@ class MergeSmallFeatures(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterNumber(self.W_FACTOR, self.tr('Weight factor'), QgsProcessingParameterNumber.Double))
 
+        self.addParameter(QgsProcessingParameterField(self.AVG_FLDS, self.tr('Other fields to average by area'), None,
+                                                      self.INPUT, QgsProcessingParameterField.Numeric, True, True))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.IN_MEMORY,
+                                                        self.tr('Process in memory and write the output once'), True))
+
+        self.addParameter(QgsProcessingParameterNumber(self.N_WORKERS, self.tr('Number of parallel workers'),
+                                                       QgsProcessingParameterNumber.Integer, 1, False, 1))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.DETERMINISTIC,
+                                                        self.tr('Keep the same merge order of the sequential run'), True))
+
+        self.addParameter(QgsProcessingParameterBoolean(self.DEFER_UNION,
+                                                        self.tr('Build the merged geometries once at the end'), False))
+
         #self.addParameter(
         #    QgsProcessingParameterNumber(self.TOLL, self.tr('Tollerance'), QgsProcessingParameterNumber.Double))
 
+        self.addParameter(QgsProcessingParameterString(self.AREA_SWEEP,
+                                                       self.tr('Other area limits (sweep, separated by semicolon)'),
+                                                       '', False, True))
+
+        self.addParameter(QgsProcessingParameterFile(self.ADJACENCY, self.tr('Adjacency table (from Find common edges)'),
+                                                     QgsProcessingParameterFile.File, 'npz', None, True))
+
         self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Merged'), QgsProcessing.TypeVectorPolygon))
+
+        self.addParameter(QgsProcessingParameterFeatureSink(self.MERGE_TABLE, self.tr('Merge table'),
+                                                            QgsProcessing.TypeVector, None, True, False))
         # self.addParameter(
         #     QgsProcessingParameterVectorLayer(self.OUTPUT, self.tr('Merged'), QgsProcessing.TypeVectorPolygon))
 
@@ -138,35 +176,233 @@ class MergeSmallFeatures(QgsProcessingAlgorithm):
         print('n. of feats',inLayer.featureCount(),'dummy',dummy,'dummy2',dummy2,'n.unres',len(unresolvedList),'nOfMin',nOfMin)
         return minFeature,nOfMin
 
-    def getSmallest(self,  inLayer, limArea,unresolvedList=[]):
-        minFeature = None
-        request = QgsFeatureRequest().setFilterExpression('$area < %s '%limArea)
-        clause = QgsFeatureRequest.OrderByClause('$area')
-        orderby = QgsFeatureRequest.OrderBy([clause])
-        request.setOrderBy(orderby)
-        # get the first that is not in unresolvedList
-        selFeatures = inLayer.getFeatures(request)
-        #print('selFeatures', selFeatures)
-
-        n=0
-        for aFeat in selFeatures:
-            n+=1
-            #print('aFeat', aFeat.id())
-            if aFeat.id() not in unresolvedList:
-                featArea = aFeat.geometry().area()
-                minFeature = aFeat
+    def fillHeap(self, heap, heapArea, areaOf, limArea, unresolvedSet):
+        # add to the priority queue the features smaller than the limit that are not queued yet
+        # heapArea stores the current key of each queued feature (lazy invalidation)
+        for fid, featArea in areaOf.items():
+            if (fid in heapArea) or (fid in unresolvedSet):
+                continue
+
+            if featArea < limArea:
+                heap.append((featArea, fid))
+                heapArea[fid] = featArea
+
+        heapq.heapify(heap)
+
+    def popSmallest(self, heap, heapArea):
+        # return the id of the smallest valid feature, skipping outdated entries
+        while heap:
+            featArea, fid = heapq.heappop(heap)
+            if heapArea.get(fid) == featArea:
+                del heapArea[fid]
+                return fid
+
+        return None
+
+    def updateKey(self, heap, heapArea, fid, featArea, limArea):
+        # the old entry of fid (if any) becomes outdated
+        heapArea.pop(fid, None)
+        if featArea < limArea:
+            heapq.heappush(heap, (featArea, fid))
+            heapArea[fid] = featArea
+
+    def buildAdjacencyGraph(self, workSet, groupFld, feedback):
+        # one-time topology pass: graph[fid][nFid] = [shared edge length, same group flag]
+        # the edge list is shared by both nodes so that updates are symmetric
+        geoms = {}
+        groupOf = {}
+        index = QgsSpatialIndex()
+        for fid, aFeat in workSet.items():
+            geoms[fid] = aFeat.geometry()
+            groupOf[fid] = aFeat[groupFld]
+            index.addFeature(aFeat)
+
+        graph = {fid: {} for fid in geoms}
+        nFeat = len(geoms)
+        processCount = 0
+        for fid, geom in geoms.items():
+            if feedback.isCanceled():
                 break
-                #print('featArea',featArea)
-                #if featArea < minArea:
-                #    minArea = featArea
-                #    minFeature = aFeat
 
-        #print('n. of feats',inLayer.featureCount(),'dummy',dummy,'dummy2',dummy2,'n.unres',len(unresolvedList),'nOfMin',nOfMin)
-        nOfMin = len(list(selFeatures))+n
-        #print('nOfMin', nOfMin)
-        #selFeatures.rewind()
+            processCount += 1
+            feedback.setProgress(100 * float(processCount) / nFeat)
 
-        return minFeature,nOfMin
+            # use prepared geometries for faster intersection tests
+            engine = QgsGeometry.createGeometryEngine(geom.constGet())
+            engine.prepareGeometry()
+
+            for nFid in index.intersects(geom.boundingBox()):
+                # each pair is processed once
+                if nFid <= fid:
+                    continue
+
+                nGeom = geoms[nFid]
+                if not engine.intersects(nGeom.constGet()):
+                    continue
+
+                iGeom = geom.intersection(nGeom)
+                if not iGeom:
+                    continue
+
+                edge = [iGeom.length(), groupOf[fid] == groupOf[nFid]]
+                graph[fid][nFid] = edge
+                graph[nFid][fid] = edge
+
+        return graph, groupOf
+
+    def layerHash(self, featList):
+        # content hash of the feature ids and geometries, the same of FindCommonEdges.layerHash
+        featHash = hashlib.sha1()
+        for fid, wkb in sorted((aFeat.id(), bytes(aFeat.geometry().asWkb())) for aFeat in featList):
+            featHash.update(str(fid).encode('utf-8'))
+            featHash.update(wkb)
+
+        return featHash.hexdigest()
+
+    def readAdjacency(self, fileName, workSet, groupFld):
+        # same graph of buildAdjacencyGraph from the CSR table saved by FindCommonEdges
+        # return (None, None) if the table was made from a different layer
+        adjacency = np.load(fileName)
+        # tables without the measure were made from the shared arcs, that miss T-junctions and touching points
+        if ('measure' not in adjacency.files) or (str(adjacency['measure']) != self.ADJACENCY_MEASURE):
+            return None, None
+
+        inputHash = self.layerHash(workSet.values())
+        if (str(adjacency['hash_a']) != inputHash) or (str(adjacency['hash_b']) != inputHash):
+            return None, None
+
+        groupOf = {fid: aFeat[groupFld] for fid, aFeat in workSet.items()}
+        graph = {fid: {} for fid in workSet}
+        indptr = adjacency['indptr'].tolist()
+        colFid = adjacency['col_fid'].tolist()
+        sharedLength = adjacency['shared_length'].tolist()
+        for i, fid in enumerate(adjacency['row_fid'].tolist()):
+            for j in range(indptr[i], indptr[i + 1]):
+                nFid = colFid[j]
+                if nFid in graph[fid]:
+                    continue
+
+                edge = [sharedLength[j], groupOf[fid] == groupOf[nFid]]
+                graph[fid][nFid] = edge
+                graph[nFid][fid] = edge
+
+        return graph, groupOf
+
+    def mergeGraphNodes(self, graph, groupOf, keepFid, dropFid, keepGroup):
+        # move the edges of dropFid to keepFid summing the shared lengths
+        keepEdges = graph[keepFid]
+        keepEdges.pop(dropFid, None)
+        for nFid, edge in graph.pop(dropFid).items():
+            if nFid == keepFid:
+                continue
+
+            del graph[nFid][dropFid]
+            if nFid in keepEdges:
+                keepEdges[nFid][0] += edge[0]
+            else:
+                keepEdges[nFid] = [edge[0], False]
+                graph[nFid][keepFid] = keepEdges[nFid]
+
+        # the merged feature could inherit the group of the dropped one
+        del groupOf[dropFid]
+        groupOf[keepFid] = keepGroup
+        for nFid, edge in keepEdges.items():
+            edge[1] = groupOf[nFid] == keepGroup
+
+    def chooseMergeTarget(self, graph, fid, wFactor):
+        # return the neighbour with the longest (weighted) common edge
+        # ties go to the smallest fid, so the result does not depend on the order of the graph
+        # (computed or read from the adjacency table)
+        selValue = -1
+        mergeWithFid = None
+        for nFid, (length, sameGroup) in graph[fid].items():
+            testValue = length
+            # if the two features belong to the same group, enhance the test value
+            if sameGroup:
+                testValue = testValue * wFactor
+
+            if (testValue > selValue) or (testValue == selValue and nFid < mergeWithFid):
+                selValue = testValue
+                mergeWithFid = nFid
+
+        return mergeWithFid
+
+    def selectIndependentSet(self, heap, heapArea, graph, areaOf, wFactor, limArea, deterministic):
+        # pop a set of small features whose merges do not interfere with each other
+        # a merge changes the merged features and the edges of their neighbours
+        mergeList = []
+        blocked = set()
+        deferred = []
+        # a merged feature smaller than areaBound could be the next smallest one
+        areaBound = limArea
+        while True:
+            minFid = self.popSmallest(heap, heapArea)
+            if minFid is None:
+                break
+
+            minArea = areaOf[minFid]
+            if deterministic and minArea >= areaBound:
+                deferred.append(minFid)
+                break
+
+            mergeWithFid = self.chooseMergeTarget(graph, minFid, wFactor)
+            if minFid in blocked or mergeWithFid in blocked:
+                deferred.append(minFid)
+                if deterministic:
+                    # the sequential order would process this feature now
+                    break
+                continue
+
+            blocked.add(minFid)
+            blocked.update(graph[minFid])
+            if mergeWithFid is not None:
+                blocked.add(mergeWithFid)
+                blocked.update(graph[mergeWithFid])
+                # the merged area is at least as large as the area of mergeWithFid
+                areaBound = min(areaBound, areaOf[mergeWithFid])
+
+            mergeList.append((minFid, mergeWithFid))
+
+        # deferred features go back to the heap for the next round
+        for fid in deferred:
+            self.updateKey(heap, heapArea, fid, areaOf[fid], limArea)
+
+        return mergeList
+
+    def findRoot(self, parent, fid):
+        # union-find root of fid (the id of the feature it is merged into) with path halving
+        while parent.get(fid, fid) != fid:
+            parent[fid] = parent.get(parent[fid], parent[fid])
+            fid = parent[fid]
+
+        return fid
+
+    def parseAreaSweep(self, sweepString):
+        # '1000;2500;5000' -> [1000.0, 2500.0, 5000.0]
+        sweepList = []
+        for item in sweepString.split(';'):
+            if not item.strip():
+                continue
+
+            try:
+                sweepList.append(float(item))
+            except ValueError:
+                raise QgsProcessingException(self.tr('Wrong area limit: %s') % item)
+
+        return sweepList
+
+    def combineGeometries(self, geomPair):
+        # return the union of the two geometries and the error message, if any
+        mergeWithGeom, minGeom = geomPair
+        newGeom = mergeWithGeom.combine(minGeom)
+        return newGeom, mergeWithGeom.lastError()
+
+    def unionGeometries(self, geomList):
+        # cascaded union of all the geometries of a merged group
+        if len(geomList) == 1:
+            return geomList[0]
+
+        return QgsGeometry.unaryUnion(geomList)
 
     def cleanZeroRing(self, geom):
         if not geom.isMultipart():
@@ -184,170 +420,224 @@ class MergeSmallFeatures(QgsProcessingAlgorithm):
         return filledGeometry
 
     def processAlgorithm(self, parameters, context, feedback):
-        inLayer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        inLayer = self.parameterAsSource(parameters, self.INPUT, context)
+        if inLayer is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
         nameFld = self.parameterAsFields(parameters, self.NAME_FLD, context)[0]
         groupFld = self.parameterAsFields(parameters, self.GROUP_FLD, context)[0]
         phiFld = self.parameterAsFields(parameters, self.PHI_FLD, context)[0]
+        # fields averaged by area, PHI first
+        avgFldList = [phiFld] + [f for f in self.parameterAsFields(parameters, self.AVG_FLDS, context) if f != phiFld]
         limArea = self.parameterAsDouble(parameters, self.AREA_LIM, context)
         wFactor = self.parameterAsDouble(parameters, self.W_FACTOR, context)
         #tollerance = self.parameterAsDouble(parameters, self.TOLL, context)
+        inMemory = self.parameterAsBoolean(parameters, self.IN_MEMORY, context)
+        nWorkers = self.parameterAsInt(parameters, self.N_WORKERS, context)
+        deterministic = self.parameterAsBoolean(parameters, self.DETERMINISTIC, context)
+        deferUnion = self.parameterAsBoolean(parameters, self.DEFER_UNION, context)
+        if deferUnion and not inMemory:
+            feedback.pushInfo(self.tr('Deferred union needs the in-memory working set, features will be processed in memory'))
+            inMemory = True
+        # area limits in increasing order, each level continues the merge of the previous one
+        levels = sorted(set([limArea] + self.parseAreaSweep(self.parameterAsString(parameters, self.AREA_SWEEP, context))))
 
-        # populate temporarily layer to use spatial selection
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
                                                inLayer.fields(), QgsWkbTypes.MultiPolygon, inLayer.sourceCrs())
         #inLayer.wkbType()
         if sink is None:
             raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
 
+        if inMemory:
+            # the merge runs on the working set and the sink is written once at the end
+            processLayer = inLayer
+        else:
+            # populate temporarily layer and save each merge to the output
+            for aFeat in inLayer.getFeatures():
+                sink.addFeature(aFeat, QgsFeatureSink.FastInsert)
+
+            del sink
+
+            processLayer = QgsProcessingUtils.mapLayerFromString(dest_id, context)
+            # the primary key (i.e. fid in geopackage) must not be overwritten
+            pkIdxList = processLayer.primaryKeyAttributes()
+
+        # load the working set, it is kept updated in both modes
+        workSet = {aFeat.id(): aFeat for aFeat in processLayer.getFeatures()}
+
+        graph = None
+        adjacencyFile = self.parameterAsFile(parameters, self.ADJACENCY, context)
+        if adjacencyFile and not inMemory:
+            feedback.pushInfo(self.tr('The adjacency table is used only when features are processed in memory'))
+        elif adjacencyFile:
+            graph, groupOf = self.readAdjacency(adjacencyFile, workSet, groupFld)
+            if graph is None:
+                feedback.pushInfo(self.tr('The adjacency table does not match the input layer or was made by an older version'))
+
+        if graph is None:
+            feedback.pushInfo(self.tr('Building adjacency graph ...'))
+            graph, groupOf = self.buildAdjacencyGraph(workSet, groupFld, feedback)
+
+        tableFields = QgsFields()
+        tableFields.append(QgsField('src_fid', QVariant.LongLong))
+        tableFields.append(QgsField('area_lim', QVariant.Double))
+        tableFields.append(QgsField('merged_into', QVariant.LongLong))
+        (tableSink, table_id) = self.parameterAsSink(parameters, self.MERGE_TABLE, context,
+                                                     tableFields, QgsWkbTypes.NoGeometry, inLayer.sourceCrs())
+
+        srcFidList = list(workSet)
+        # area of each feature, the sum of the merged areas in deferred mode
+        areaOf = {fid: aFeat.geometry().area() for fid, aFeat in workSet.items()}
+        # original geometries, united once at the end in deferred mode
+        srcGeom = {fid: aFeat.geometry() for fid, aFeat in workSet.items()} if deferUnion else None
+        # union-find of the merges, parent[minFid] = mergeWithFid
+        parent = {}
+        unresolvedSet = set()
+        heap = []
+        heapArea = {}
+
+        executor = None
+        if nWorkers > 1:
+            # GEOS operations release the GIL, so the unions of a round run concurrently
+            executor = ThreadPoolExecutor(max_workers=nWorkers)
 
-        for aFeat in inLayer.getFeatures():
-            sink.addFeature(aFeat, QgsFeatureSink.FastInsert)
-
-        del sink
-
-        unresolvedList = []
-        processLayer = QgsProcessingUtils.mapLayerFromString(dest_id, context)
-
-        minFeat, smallAreaCount = self.getSmallest(processLayer, limArea, unresolvedList)
-
-        feedback.pushInfo(self.tr('Num. of small features to be processed: %s') % smallAreaCount)
-
-        # while a feature with area lower then limit
         processCount=0
-        while minFeat:
-            if feedback.isCanceled():
-                break
-
-            processCount+=1
-            if smallAreaCount>0:
-                feedback.setProgress(100 * float(processCount) / smallAreaCount)
-            else:
-                print('minFeat',minFeat)
-            #feedback.pushInfo(self.tr('Processing feature fid=%s with area %s')%(minFeat['fid'],minFeat.geometry().area()))
-            # get surrounding features
-            # Delete all features to eliminate in processLayer
-
-            processLayer.startEditing()
-
-            #feedback.pushInfo(self.tr('Data provider caps: %s')%processLayer.dataProvider().capabilitiesString())
-
-            minPhi = minFeat[phiFld]
-
-            minGeom = minFeat.geometry()
-            bbox = minGeom.boundingBox()
-            fit = processLayer.getFeatures(
-                QgsFeatureRequest().setFilterRect(bbox).setSubsetOfAttributes([]))
-
-            selFeat = QgsFeature()
-
-            # use prepared geometries for faster intersection tests
-            engine = QgsGeometry.createGeometryEngine(minGeom.constGet())
-            engine.prepareGeometry()
-
-            selValue = -1
-            mergeWithFid = None
-
-            while fit.nextFeature(selFeat):
-                selGeom = selFeat.geometry()
-
-                if engine.intersects(selGeom.constGet()):
-                    # We have a candidate
-                    iGeom = minGeom.intersection(selGeom)
-
-                    if not iGeom:
-                        continue
-
-                    testValue = iGeom.length()
-                    # if the two features belong to the same group, enhance the test value
-                    if selFeat[groupFld]==minFeat[groupFld]:
-                        testValue=testValue*wFactor
-
-                    # if the merged feature has an area > (1+tollerance)*limarea
-                    #newGeom = selGeom.combine(geom2Eliminate)
-
-                    if (testValue>selValue)\
-                        and (selFeat.id()!=minFeat.id()):
-                        #and (newGeom.area()<=(1+tollerance)*limArea):
-
-                        selValue = testValue
-                        #feedback.pushInfo('selFeat attr: %s' % selFeat.attributes())
-                        mergeWithFeat = QgsFeature(processLayer.getFeature(selFeat.id()))
-                        mergeWithFid = selFeat.id()
-                        mergeWithPhi = mergeWithFeat[phiFld]
-                        mergeWithGeom = QgsGeometry(selGeom)
-
-
-                    # if (-1 != selValue) and (selFeat.id()!=minFeat.id()):
-                    #     useThis = True
-                    #     if useThis:
-                    #         mergeWithFid = selFeat.id()
-                    #         mergeWithGeom = QgsGeometry(selGeom)
-
-            # End while fit
-
-            if mergeWithFid is not None:
-                # A successful candidate
-                newGeom = mergeWithGeom.combine(minGeom)
-                #newGeom = self.cleanZeroRing(newGeom)
-                if mergeWithGeom.lastError():
-                    feedback.error(
-                        self.tr('merge %s (smallest) with %s return error: %s') %
-                                (minFeat[nameFld], mergeWithFeat[nameFld],mergeWithGeom.lastError()),
-                        True)
-
-                #feedback.pushInfo('mergeWithFeat attr: %s'%mergeWithFeat.attributes())
-
-                #feedback.pushInfo(
-                #    self.tr('merge %s (smallest) with %s') % (minFeat[nameFld], mergeWithFeat[nameFld]))
-
-                #if minFeat.id() == mergeWithFid:
-                #    break
-
-                #feedback.pushInfo(
-                #    self.tr('Old area %s replaced with new area %s') % (mergeWithGeom.area(), newGeom.area()))
-                #feedback.pushInfo(self.tr('Merge with %s') % mergeWithFid)
-                # get attributes from the largest feature
-                if mergeWithGeom.area()>minGeom.area():
-                    newFeat = QgsFeature(mergeWithFeat)
+        for limArea in levels:
+            self.fillHeap(heap, heapArea, areaOf, limArea, unresolvedSet)
+            feedback.pushInfo(self.tr('Num. of small features to be processed with area limit %s: %s') %
+                              (limArea, len(heapArea)))
+
+            # while a feature with area lower then limit
+            while not feedback.isCanceled():
+                if executor and not deferUnion:
+                    mergeList = self.selectIndependentSet(heap, heapArea, graph, areaOf, wFactor, limArea, deterministic)
                 else:
-                    newFeat = QgsFeature(minFeat)
-
-                # update geometry with the merge result
-                newFeat.setGeometry(newGeom)
+                    minFid = self.popSmallest(heap, heapArea)
+                    mergeList = []
+                    if minFid is not None:
+                        mergeList.append((minFid, self.chooseMergeTarget(graph, minFid, wFactor)))
+
+                if not mergeList:
+                    break
+
+                geomPairList = []
+                if not deferUnion:
+                    geomPairList = [(workSet[mergeWithFid].geometry(), workSet[minFid].geometry())
+                                    for minFid, mergeWithFid in mergeList if mergeWithFid is not None]
+                if executor:
+                    newGeomList = executor.map(self.combineGeometries, geomPairList)
+                else:
+                    newGeomList = map(self.combineGeometries, geomPairList)
 
-                # calculate new phi
-                newPhi = (mergeWithPhi*mergeWithFeat.geometry().area()+minPhi*minFeat.geometry().area())/newGeom.area()
+                # merges are applied in selection order
+                for minFid, mergeWithFid in mergeList:
+                    processCount+=1
+                    # remaining features are the valid entries still in the heap
+                    feedback.setProgress(100 * float(processCount) / (processCount + len(heapArea)))
 
-                newFeat[phiFld]=newPhi
+                    minFeat = workSet[minFid]
+                    minArea = areaOf[minFid]
 
-                #feedback.pushInfo(
-                #    self.tr('New feature with area %s') % (newFeat.geometry().area()))
+                    if mergeWithFid is None:
+                        feedback.pushInfo(self.tr('Could not resolve feature with name %s')%minFeat[nameFld])
+                        unresolvedSet.add(minFid)
+                        continue
 
-                if not processLayer.deleteFeatures([minFeat.id(),mergeWithFid]):
-                    feedback.error(
-                        self.tr('Could not delete geometry of feature with name %s')%minFeat[nameFld])
+                    # A successful candidate
+                    mergeWithFeat = workSet[mergeWithFid]
+                    mergeWithArea = areaOf[mergeWithFid]
+                    if deferUnion:
+                        newGeom = None
+                        newArea = mergeWithArea + minArea
+                    else:
+                        newGeom, mergeError = next(newGeomList)
+                        if mergeError:
+                            feedback.error(
+                                self.tr('merge %s (smallest) with %s return error: %s') %
+                                        (minFeat[nameFld], mergeWithFeat[nameFld],mergeError),
+                                True)
+
+                        newArea = newGeom.area()
+
+                    # get attributes from the largest feature
+                    if mergeWithArea>minArea:
+                        newFeat = QgsFeature(mergeWithFeat)
+                    else:
+                        newFeat = QgsFeature(minFeat)
+
+                    # update geometry with the merge result
+                    if newGeom is not None:
+                        newFeat.setGeometry(newGeom)
+                    # the merged feature keeps the id of mergeWithFid so that the heap stays consistent
+                    newFeat.setId(mergeWithFid)
+
+                    # calculate new phi and the other averaged fields
+                    for avgFld in avgFldList:
+                        newFeat[avgFld] = (mergeWithFeat[avgFld]*mergeWithArea+minFeat[avgFld]*minArea)/newArea
+
+                    if not inMemory:
+                        processLayer.startEditing()
+
+                        newValues = {i: v for i, v in enumerate(newFeat.attributes()) if i not in pkIdxList}
+
+                        if not processLayer.deleteFeature(minFid):
+                            feedback.error(
+                                self.tr('Could not delete geometry of feature with name %s')%minFeat[nameFld])
+
+                        if not (processLayer.changeGeometry(mergeWithFid, newGeom) and
+                                processLayer.changeAttributeValues(mergeWithFid, newValues)):
+                            feedback.error(self.tr('Could not update feature with name %s')%mergeWithFeat[nameFld])
+
+                        # save changes
+                        if not processLayer.commitChanges():
+                            errList = processLayer.commitErrors()
+                            feedback.pushInfo('\n'.join(errList))
+
+                    del workSet[minFid]
+                    workSet[mergeWithFid] = newFeat
+                    del areaOf[minFid]
+                    areaOf[mergeWithFid] = newArea
+                    parent[minFid] = mergeWithFid
+
+                    self.mergeGraphNodes(graph, groupOf, mergeWithFid, minFid, newFeat[groupFld])
+
+                    # only the key of the merged feature changes
+                    self.updateKey(heap, heapArea, mergeWithFid, newArea, limArea)
+
+            if tableSink is not None:
+                # snapshot of the merges at this area limit
+                rowList = []
+                for fid in srcFidList:
+                    row = QgsFeature(tableFields)
+                    row.setAttributes([fid, limArea, self.findRoot(parent, fid)])
+                    rowList.append(row)
+
+                tableSink.addFeatures(rowList, QgsFeatureSink.FastInsert)
+
+        if deferUnion:
+            # one cascaded union for each group of merged features
+            memberList = {}
+            for fid in srcFidList:
+                memberList.setdefault(self.findRoot(parent, fid), []).append(srcGeom[fid])
+
+            rootList = list(workSet)
+            geomListList = [memberList[fid] for fid in rootList]
+            if executor:
+                newGeomList = executor.map(self.unionGeometries, geomListList)
+            else:
+                newGeomList = map(self.unionGeometries, geomListList)
 
-                if not processLayer.addFeature(newFeat):
-                    feedback.error(self.tr('Could not add new feature with name %s')%mergeWithFeat[nameFld])
+            for fid, newGeom in zip(rootList, newGeomList):
+                workSet[fid].setGeometry(newGeom)
 
-                # if processLayer.changeGeometry(mergeWithFid, newGeom):
-                #     feedback.pushInfo(self.tr('New geometry area is %s')%(processLayer.getFeature(mergeWithFid).geometry().area()))
-                #     madeProgress = True
-                # else:
-                #     feedback.pushInfo(self.tr('Could not replace geometry of feature with id {0}').format(mergeWithFid))
-            else:
-                feedback.pushInfo(self.tr('Could not resolve feature with name %s')%minFeat[nameFld])
-                unresolvedList.append(minFeat.id())
+        if executor:
+            executor.shutdown()
 
-            # save changes
-            if not processLayer.commitChanges():
-                errList = processLayer.commitErrors()
-                feedback.pushInfo('\n'.join(errList))
-                #raise QgsProcessingException(self.tr('Could not commit changes'))
+        if inMemory:
+            # bulk write of the merged features
+            if not sink.addFeatures(list(workSet.values()), QgsFeatureSink.FastInsert):
+                feedback.reportError(self.tr('Could not write the merged features to the output'))
 
-            # calculate new minFeat
-            minFeat,smallAreaCount = self.getSmallest(processLayer, limArea,unresolvedList)
-            #print('minfeat',minFeat,'n.smallareas',smallAreaCount,'process count',processCount)
+            del sink
 
         #
         # algResults = processing.run("native:deleteholes", {
@@ -364,4 +654,7 @@ class MergeSmallFeatures(QgsProcessingAlgorithm):
         #
         # dest_id = algResults['OUTPUT']
 
-        return {self.OUTPUT: dest_id}
+        if tableSink is not None:
+            del tableSink
+
+        return {self.OUTPUT: dest_id, self.MERGE_TABLE: table_id}
@@ -0,0 +1,795 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+    optain_cli.py
+    ---------------------
+    Date                 : October 2026
+    Copyright         : (C) 2026 by Enrico A. Chiaradia
+    Email                : enrico.chiaradia@unimi.it
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+Headless version of the OPTAIN tools. It does not need QGIS: the layers are
+read and written with geopandas (GeoPackage, GeoParquet or any OGR format) and
+the geometry work is done with shapely 2 array operations.
+
+usage:
+    python optain_cli.py merge-small-features INPUT OUTPUT --area-lim 5000 --name-fld name
+                                              --group-fld group --phi-fld phi --w-factor 2
+    python optain_cli.py clean-overlap INPUT OUTPUT [--method overlay --owner-rule area]
+    python optain_cli.py find-common-edges LAYER1 LAYER2 OUTPUT [--method arcs --snap 0.01]
+    python optain_cli.py join-nodes-links NODES LINKS OUTPUT
+    python optain_cli.py join-links-landuse LANDUSE LINKS OUTPUT
+
+A layer inside a GeoPackage can be selected with path/to/file.gpkg|layername=name
+"""
+
+__author__ = 'Enrico A. Chiaradia'
+__date__ = 'October 2026'
+__copyright__ = '(C) 2026, Enrico A. Chiaradia'
+
+import argparse
+import hashlib
+import heapq
+import json
+import sys
+import time
+
+# numpy, pandas, shapely and geopandas are imported by main() so that --help is immediate
+np = None
+pd = None
+shapely = None
+gpd = None
+
+# how shared_length of the adjacency table is measured, the same of the QGIS tools
+ADJACENCY_MEASURE = 'intersection_length'
+
+
+def importLibs():
+    global np, pd, shapely, gpd
+    import numpy
+    import pandas
+    import shapely as shapelyLib
+    import geopandas
+    np = numpy
+    pd = pandas
+    shapely = shapelyLib
+    gpd = geopandas
+
+
+class Feedback:
+    """
+    Minimal replacement of QgsProcessingFeedback that prints to stderr.
+    """
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        # run time in seconds of each phase
+        self.timings = {}
+        self.phaseName = None
+        self.phaseStart = None
+
+    def pushInfo(self, msg):
+        if not self.quiet:
+            print(msg, file=sys.stderr)
+
+    def reportError(self, msg):
+        print(msg, file=sys.stderr)
+
+    def isCanceled(self):
+        return False
+
+    def setPhase(self, name):
+        # close the running phase and start a new one, None only closes it
+        now = time.perf_counter()
+        if self.phaseName is not None:
+            self.timings[self.phaseName] = self.timings.get(self.phaseName, 0.) + now - self.phaseStart
+
+        self.phaseName = name
+        self.phaseStart = now
+
+
+def splitList(text):
+    # items separated by semicolon as in the QGIS tools, comma is accepted too
+    return [item.strip() for item in text.replace(',', ';').split(';') if item.strip()]
+
+
+def readLayer(path):
+    # path can be file.parquet, file.gpkg or file.gpkg|layername=name
+    fileName, _, layerName = path.partition('|layername=')
+    if fileName.lower().endswith('.parquet'):
+        return gpd.read_parquet(fileName)
+
+    # the index is the feature id, as in QGIS (1-based in a GeoPackage)
+    return gpd.read_file(fileName, layer=layerName or None, fid_as_index=True)
+
+
+def writeLayer(gdf, path):
+    fileName, _, layerName = path.partition('|layername=')
+    if fileName.lower().endswith('.parquet'):
+        gdf.to_parquet(fileName)
+    else:
+        gdf.to_file(fileName, layer=layerName or None)
+
+
+def find(parent, i):
+    # union-find root with path halving
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+
+    return i
+
+
+def layerHash(gdf):
+    # content hash of the feature ids and of the ISO WKB geometries, sorted by id as in the QGIS tools
+    featHash = hashlib.sha1()
+    wkbList = shapely.to_wkb(gdf.geometry.to_numpy(), flavor='iso', byte_order=1).tolist()
+    for label, wkb in sorted(zip(gdf.index.tolist(), wkbList)):
+        featHash.update(str(label).encode('utf-8'))
+        featHash.update(wkb)
+
+    return featHash.hexdigest()
+
+
+def adjacencyPairs(gdf1, gdf2, sameLayer):
+    # index labels and intersection length of the touching polygons, the same measure of mergeSmallFeatures
+    geoms1, geoms2 = gdf1.geometry.to_numpy(), gdf2.geometry.to_numpy()
+    idx2, idx1 = shapely.STRtree(geoms2).query(geoms1, predicate='intersects')
+    if sameLayer:
+        mask = idx1 != idx2
+        idx1, idx2 = idx1[mask], idx2[mask]
+
+    lengths = shapely.length(shapely.intersection(geoms1[idx1], geoms2[idx2]))
+    return gdf1.index.to_numpy()[idx1], gdf2.index.to_numpy()[idx2], lengths
+
+
+def saveAdjacency(fileName, fidA, fidB, sharedLength, hashA, hashB):
+    # sparse adjacency in CSR format: the neighbours of row_fid[i] are col_fid[indptr[i]:indptr[i + 1]]
+    pairs = pd.DataFrame({'a': fidA, 'b': fidB, 'length': sharedLength}).groupby(['a', 'b'], sort=True).sum()
+    rowList = pairs.index.get_level_values(0).to_numpy(dtype=np.int64)
+    rowFid = np.unique(rowList)
+    indptr = np.append(np.searchsorted(rowList, rowFid, 'left'), len(rowList)).astype(np.int64)
+    np.savez(fileName, hash_a=np.array(hashA), hash_b=np.array(hashB), measure=np.array(ADJACENCY_MEASURE),
+             row_fid=rowFid, indptr=indptr,
+             col_fid=pairs.index.get_level_values(1).to_numpy(dtype=np.int64),
+             shared_length=pairs['length'].to_numpy(dtype=np.float64))
+
+
+def readAdjacency(fileName, gdf):
+    # pairs of positions (i < j) and shared lengths from a symmetric CSR table of gdf, None if it does not match
+    adjacency = np.load(fileName)
+    # tables without the measure were made from the shared arcs, that miss T-junctions and touching points
+    if ('measure' not in adjacency.files) or (str(adjacency['measure']) != ADJACENCY_MEASURE):
+        return None
+
+    inputHash = layerHash(gdf)
+    if (str(adjacency['hash_a']) != inputHash) or (str(adjacency['hash_b']) != inputHash):
+        return None
+
+    counts = np.diff(adjacency['indptr'])
+    left = gdf.index.get_indexer(np.repeat(adjacency['row_fid'], counts))
+    right = gdf.index.get_indexer(adjacency['col_fid'])
+    lengths = adjacency['shared_length']
+    mask = left < right
+    return left[mask], right[mask], lengths[mask]
+
+
+def mergeSmallFeatures(gdf, limArea, nameFld, groupFld, phiFld, wFactor, feedback, areaSweep=(), avgFlds=(),
+                       adjacencyFile=None, withTable=False):
+    geoms = gdf.geometry.to_numpy()
+    nFeat = len(geoms)
+    areas = shapely.area(geoms).tolist()
+    groupOf = gdf[groupFld].tolist()
+    # running sums of the area weighted values, PHI first
+    avgFldList = [phiFld] + [f for f in avgFlds if f != phiFld]
+    valueSum = {f: (gdf[f].to_numpy(dtype=float) * shapely.area(geoms)).tolist() for f in avgFldList}
+    names = gdf[nameFld].tolist()
+
+    feedback.setPhase('adjacency')
+    # adjacency graph from a bulk STRtree query, graph[i][j] = [shared edge length, same group flag]
+    adjacency = readAdjacency(adjacencyFile, gdf) if adjacencyFile else None
+    if adjacencyFile and adjacency is None:
+        feedback.pushInfo('The adjacency table does not match the input layer')
+
+    if adjacency is not None:
+        left, right, lengths = adjacency
+    else:
+        tree = shapely.STRtree(geoms)
+        left, right = tree.query(geoms, predicate='intersects')
+        mask = left < right
+        left, right = left[mask], right[mask]
+        lengths = shapely.length(shapely.intersection(geoms[left], geoms[right]))
+
+    graph = [{} for _ in range(nFeat)]
+    for i, j, length in zip(left.tolist(), right.tolist(), lengths.tolist()):
+        edge = [length, groupOf[i] == groupOf[j]]
+        graph[i][j] = edge
+        graph[j][i] = edge
+
+    feedback.pushInfo('Adjacency graph with %s edges' % len(left))
+
+    feedback.setPhase('merge')
+    # attributes come from the largest feature of each group
+    donor = list(range(nFeat))
+    parent = list(range(nFeat))
+
+    # area limits in increasing order, each level continues the merge of the previous one
+    levels = sorted(set([limArea] + list(areaSweep)))
+    tableList = []
+    heap = []
+    heapArea = {}
+    unresolvedSet = set()
+    for limArea in levels:
+        for i in range(nFeat):
+            if parent[i] == i and i not in heapArea and i not in unresolvedSet and areas[i] < limArea:
+                heap.append((areas[i], i))
+                heapArea[i] = areas[i]
+
+        heapq.heapify(heap)
+        feedback.pushInfo('Num. of small features to be processed with area limit %s: %s' % (limArea, len(heapArea)))
+
+        while heap:
+            minArea, minIdx = heapq.heappop(heap)
+            if heapArea.get(minIdx) != minArea:
+                continue
+
+            del heapArea[minIdx]
+
+            # neighbour with the longest (weighted) common edge, ties go to the first feature
+            selValue = -1
+            mergeWith = None
+            for nIdx, (length, sameGroup) in graph[minIdx].items():
+                testValue = length * wFactor if sameGroup else length
+                if (testValue > selValue) or (testValue == selValue and nIdx < mergeWith):
+                    selValue = testValue
+                    mergeWith = nIdx
+
+            if mergeWith is None:
+                feedback.pushInfo('Could not resolve feature with name %s' % names[donor[minIdx]])
+                unresolvedSet.add(minIdx)
+                continue
+
+            if areas[minIdx] >= areas[mergeWith]:
+                donor[mergeWith] = donor[minIdx]
+                groupOf[mergeWith] = groupOf[minIdx]
+
+            parent[minIdx] = mergeWith
+            areas[mergeWith] += areas[minIdx]
+            for fldSum in valueSum.values():
+                fldSum[mergeWith] += fldSum[minIdx]
+
+            # move the edges of minIdx to mergeWith
+            keepEdges = graph[mergeWith]
+            keepEdges.pop(minIdx, None)
+            for nIdx, edge in graph[minIdx].items():
+                if nIdx == mergeWith:
+                    continue
+
+                del graph[nIdx][minIdx]
+                if nIdx in keepEdges:
+                    keepEdges[nIdx][0] += edge[0]
+                else:
+                    keepEdges[nIdx] = [edge[0], False]
+                    graph[nIdx][mergeWith] = keepEdges[nIdx]
+
+            graph[minIdx] = {}
+            for nIdx, edge in keepEdges.items():
+                edge[1] = groupOf[nIdx] == groupOf[mergeWith]
+
+            heapArea.pop(mergeWith, None)
+            if areas[mergeWith] < limArea:
+                heapq.heappush(heap, (areas[mergeWith], mergeWith))
+                heapArea[mergeWith] = areas[mergeWith]
+
+        if withTable:
+            # snapshot of the merges at this area limit
+            tableList.append(pd.DataFrame({'src_fid': gdf.index,
+                                           'area_lim': limArea,
+                                           'merged_into': gdf.index[[find(parent, i) for i in range(nFeat)]]}))
+
+    feedback.setPhase('union')
+    # one union for each group of merged features
+    members = {}
+    for i in range(nFeat):
+        members.setdefault(find(parent, i), []).append(i)
+
+    rootList = sorted(members)
+    newGeoms = [geoms[r] if len(members[r]) == 1 else shapely.union_all(geoms[members[r]]) for r in rootList]
+
+    result = gdf.iloc[[donor[r] for r in rootList]].copy()
+    for f, fldSum in valueSum.items():
+        result[f] = [fldSum[r] / areas[r] if len(members[r]) > 1 else value
+                     for r, value in zip(rootList, result[f].tolist())]
+    result[result.geometry.name] = gpd.GeoSeries(newGeoms, index=result.index, crs=gdf.crs)
+    mergeTable = pd.concat(tableList, ignore_index=True) if tableList else None
+    feedback.setPhase(None)
+    return result, mergeTable
+
+
+def overlapReport(gdf, idx1, idx2, overlaps):
+    # one row for each overlap with a positive area: ids of the two polygons, area, centroid and overlap geometry
+    # only the polygon parts of the overlaps are kept
+    parts, partIdx = shapely.get_parts(overlaps, return_index=True)
+    isPoly = (shapely.get_type_id(parts) == 3) & (shapely.area(parts) > 0)
+    parts, partIdx = parts[isPoly], partIdx[isPoly]
+    keep, rowIdx = np.unique(partIdx, return_inverse=True)
+    iGeoms = shapely.multipolygons(parts, indices=rowIdx) if len(keep) else np.zeros(0, dtype=object)
+    centroids = shapely.centroid(iGeoms)
+    return gpd.GeoDataFrame({'poly1': gdf.index[idx1[keep]],
+                             'poly2': gdf.index[idx2[keep]],
+                             'area': shapely.area(iGeoms),
+                             'centroid_x': shapely.get_x(centroids),
+                             'centroid_y': shapely.get_y(centroids)},
+                            geometry=iGeoms, crs=gdf.crs)
+
+
+def cleanOverlap(gdf, feedback, report=False):
+    geoms = gdf.geometry.to_numpy()
+
+    feedback.setPhase('candidates')
+    # each unordered pair once: the first feature is cut by the following ones
+    tree = shapely.STRtree(geoms)
+    left, right = tree.query(geoms, predicate='intersects')
+    mask = left < right
+    left, right = left[mask], right[mask]
+    feedback.pushInfo('Num. of intersecting pairs: %s' % len(left))
+
+    reportGdf = None
+    if report:
+        feedback.setPhase('report')
+        reportGdf = overlapReport(gdf, left, right, shapely.intersection(geoms[left], geoms[right]))
+
+    feedback.setPhase('difference')
+    order = np.argsort(left, kind='stable')
+    left, right = left[order], right[order]
+    cutIdx, start = np.unique(left, return_index=True)
+    cutters = [shapely.union_all(geoms[r]) for r in np.split(right, start[1:])] if len(left) else []
+
+    newGeoms = geoms.copy()
+    if len(cutIdx):
+        newGeoms[cutIdx] = shapely.difference(geoms[cutIdx], np.array(cutters, dtype=object))
+
+    result = gdf.copy()
+    result[result.geometry.name] = gpd.GeoSeries(newGeoms, index=gdf.index, crs=gdf.crs)
+    feedback.setPhase(None)
+    return result, reportGdf
+
+
+def cleanOverlapOverlay(gdf, feedback, ownerRule='last', priorityFld=None, report=False):
+    # planar overlay: node all the boundaries, polygonize and give each face to one of the covering polygons
+    geoms = gdf.geometry.to_numpy()
+
+    feedback.setPhase('overlay')
+    noded = shapely.union_all(shapely.boundary(geoms))
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(noded)))
+    feedback.pushInfo('Num. of faces: %s' % len(faces))
+
+    feedback.setPhase('owner')
+    # faces that are not covered by any polygon are gaps of the input
+    tree = shapely.STRtree(geoms)
+    faceIdx, polyIdx = tree.query(shapely.point_on_surface(faces), predicate='within')
+    if ownerRule == 'area':
+        primary = shapely.area(geoms)[polyIdx]
+    elif ownerRule == 'priority':
+        # missing priorities are the lowest
+        primary = np.nan_to_num(gdf[priorityFld].to_numpy(dtype=float), nan=-np.inf)[polyIdx]
+    else:
+        primary = np.zeros(len(polyIdx))
+
+    # the last of each face has the largest key, ties go to the first polygon
+    # with the last rule the latest polygon wins, as with the pairwise difference
+    order = np.lexsort((polyIdx if ownerRule == 'last' else -polyIdx, primary, faceIdx))
+    faceIdx, polyIdx = faceIdx[order], polyIdx[order]
+    last = np.r_[faceIdx[1:] != faceIdx[:-1], True] if len(faceIdx) else np.zeros(0, dtype=bool)
+
+    reportGdf = None
+    if report:
+        # the polygons that lose a face, with the owner of the face
+        ownerOf = np.zeros(len(faces), dtype=int)
+        ownerOf[faceIdx[last]] = polyIdx[last]
+        loser = ~last
+        reportGdf = overlapReport(gdf, polyIdx[loser], ownerOf[faceIdx[loser]], faces[faceIdx[loser]])
+
+    faceIdx, polyIdx = faceIdx[last], polyIdx[last]
+
+    feedback.setPhase('union')
+    order = np.argsort(polyIdx, kind='stable')
+    faceIdx, polyIdx = faceIdx[order], polyIdx[order]
+    ownerIdx, start = np.unique(polyIdx, return_index=True)
+    newGeoms = np.array([shapely.Polygon()] * len(geoms), dtype=object)
+    if len(ownerIdx):
+        newGeoms[ownerIdx] = [shapely.union_all(faces[f]) for f in np.split(faceIdx, start[1:])]
+
+    result = gdf.copy()
+    result[result.geometry.name] = gpd.GeoSeries(newGeoms, index=gdf.index, crs=gdf.crs)
+    feedback.setPhase(None)
+    return result, reportGdf
+
+
+def extendLine(geom, startDist, endDist):
+    # same as QgsGeometry.extendLine, each part is extended along its first and last segment
+    parts = []
+    for part in shapely.get_parts(geom):
+        coords = shapely.get_coordinates(part)
+        if len(coords) >= 2:
+            d0 = coords[0] - coords[1]
+            d1 = coords[-1] - coords[-2]
+            n0 = np.hypot(*d0)
+            n1 = np.hypot(*d1)
+            if n0 > 0:
+                coords[0] = coords[0] + d0 / n0 * startDist
+            if n1 > 0:
+                coords[-1] = coords[-1] + d1 / n1 * endDist
+
+        parts.append(shapely.linestrings(coords))
+
+    if len(parts) == 1:
+        return parts[0]
+
+    return shapely.multilinestrings(parts)
+
+
+def findCommonEdges(gdf1, gdf2, feedback, addLength=20):
+    geoms1 = gdf1.geometry.to_numpy()
+    geoms2 = gdf2.geometry.to_numpy()
+
+    feedback.setPhase('candidates')
+    # external ring of the first part of each polygon
+    rings1 = shapely.get_exterior_ring(shapely.get_geometry(geoms1, 0))
+    rings2 = shapely.get_exterior_ring(shapely.get_geometry(geoms2, 0))
+
+    # bounding box candidates
+    idx2, idx1 = shapely.STRtree(geoms1).query(geoms2)
+    hit = shapely.intersects(rings1[idx1], rings2[idx2])
+    idx1, idx2 = idx1[hit], idx2[hit]
+
+    feedback.setPhase('difference')
+    edges = shapely.difference(rings1[idx1], rings2[idx2])
+    notEmpty = ~shapely.is_empty(edges)
+    edges = [extendLine(e, addLength, addLength) for e in edges[notEmpty]]
+    feedback.pushInfo('Num. of common edges: %s' % len(edges))
+
+    # same fields of the second layer, without values
+    result = gpd.GeoDataFrame({c: [None] * len(edges) for c in gdf2.columns if c != gdf2.geometry.name},
+                              geometry=edges, crs=gdf2.crs)
+    feedback.setPhase(None)
+    return result
+
+
+def boundarySegments(geoms, snap=0):
+    # all the segments of all the rings of all the parts, with the polygon on the right side
+    # return start points, end points and index of the polygon of each segment
+    parts, partOwner = shapely.get_parts(geoms, return_index=True)
+    rings, ringPart = shapely.get_rings(parts, return_index=True)
+    # the exterior ring comes first, then the holes
+    isExterior = np.r_[True, ringPart[1:] != ringPart[:-1]] if len(rings) else np.zeros(0, dtype=bool)
+    coords, coordRing = shapely.get_coordinates(rings, return_index=True)
+    if snap > 0:
+        coords = np.round(coords / snap) * snap
+
+    # no negative zeros, segments are matched by their bytes
+    coords = coords + 0.
+
+    same = coordRing[1:] == coordRing[:-1]
+    start, end, segRing = coords[:-1][same], coords[1:][same], coordRing[:-1][same]
+
+    # signed area, positive if counter-clockwise: exterior rings must be clockwise and holes counter-clockwise
+    cross = start[:, 0] * end[:, 1] - end[:, 0] * start[:, 1]
+    signedArea = np.bincount(segRing, weights=cross, minlength=len(rings))
+    flip = ((signedArea > 0) == isExterior)[segRing][:, None]
+    start, end = np.where(flip, end, start), np.where(flip, start, end)
+
+    # segments collapsed by the snapping
+    keep = np.any(start != end, axis=1)
+    return start[keep], end[keep], partOwner[ringPart[segRing[keep]]]
+
+
+def segmentKeys(start, end):
+    # the same key for both directions of a segment, as one void item for sorting and searching
+    swap = (start[:, 0] > end[:, 0]) | ((start[:, 0] == end[:, 0]) & (start[:, 1] > end[:, 1]))
+    keys = np.ascontiguousarray(np.where(swap[:, None], np.hstack([end, start]), np.hstack([start, end])))
+    return keys.view(np.dtype((np.void, keys.dtype.itemsize * 4))).ravel()
+
+
+def findSharedArcs(gdf1, gdf2, feedback, snap=0, sameLayer=False):
+    # shared arcs between the polygons of the first layer (right side) and of the second layer (left side)
+    # segments are matched by their end points, so adjacent polygons must share the vertices
+    feedback.setPhase('segments')
+    start1, end1, owner1 = boundarySegments(gdf1.geometry.to_numpy(), snap)
+    start2, end2, owner2 = boundarySegments(gdf2.geometry.to_numpy(), snap)
+    keys1 = segmentKeys(start1, end1)
+    keys2 = segmentKeys(start2, end2)
+
+    feedback.setPhase('match')
+    order2 = np.argsort(keys2, kind='stable')
+    keys2 = keys2[order2]
+    lo = np.searchsorted(keys2, keys1, 'left')
+    counts = np.searchsorted(keys2, keys1, 'right') - lo
+    seg1 = np.repeat(np.arange(len(keys1)), counts)
+    pos = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    fid1, fid2 = owner1[seg1], owner2[order2[pos]]
+    if sameLayer:
+        # each pair once
+        keep = fid2 > fid1
+        seg1, fid1, fid2 = seg1[keep], fid1[keep], fid2[keep]
+
+    feedback.setPhase('arcs')
+    # segments of each pair in the ring order, then merged into arcs
+    order = np.lexsort((seg1, fid2, fid1))
+    seg1, fid1, fid2 = seg1[order], fid1[order], fid2[order]
+    pairStart = np.r_[True, (fid1[1:] != fid1[:-1]) | (fid2[1:] != fid2[:-1])] if len(seg1) else np.zeros(0, dtype=bool)
+    pairIdx = np.cumsum(pairStart) - 1
+    segLines = shapely.linestrings(np.stack([start1[seg1], end1[seg1]], axis=1)) if len(seg1) else np.zeros(0, dtype=object)
+    arcs = shapely.line_merge(shapely.multilinestrings(segLines, indices=pairIdx), directed=True) if len(seg1) \
+        else np.zeros(0, dtype=object)
+    arcs, arcPair = shapely.get_parts(arcs, return_index=True)
+    feedback.pushInfo('Num. of shared arcs: %s' % len(arcs))
+
+    result = gpd.GeoDataFrame({'left_fid': gdf2.index[fid2[pairStart][arcPair]],
+                               'right_fid': gdf1.index[fid1[pairStart][arcPair]],
+                               'length': shapely.length(arcs)},
+                              geometry=arcs, crs=gdf2.crs)
+    feedback.setPhase(None)
+    return result
+
+
+def nearestLinks(nodes, nodeGeoms, tree, linkIds, topK, maxDist):
+    # the topK links within maxDist of each node, with distance and rank
+    nodeIdx, linkIdx = tree.query(nodeGeoms, predicate='dwithin', distance=maxDist)
+    dist = shapely.distance(nodeGeoms[nodeIdx], tree.geometries[linkIdx])
+    order = np.lexsort((linkIdx, dist, nodeIdx))
+    nodeIdx, linkIdx, dist = nodeIdx[order], linkIdx[order], dist[order]
+    # rank inside the candidates of each node
+    first = np.r_[True, nodeIdx[1:] != nodeIdx[:-1]] if len(nodeIdx) else np.zeros(0, dtype=bool)
+    start = np.maximum.accumulate(np.where(first, np.arange(len(nodeIdx)), 0))
+    rank = np.arange(len(nodeIdx)) - start + 1
+    keep = rank <= topK
+    nodeIdx, linkIdx = nodeIdx[keep], linkIdx[keep]
+    return pd.DataFrame({'node_fid': nodes.index[nodeIdx],
+                         'link_id': linkIds[linkIdx],
+                         'distance': dist[keep],
+                         'rank': rank[keep],
+                         'link_pos': shapely.line_locate_point(tree.geometries[linkIdx], nodeGeoms[nodeIdx])})
+
+
+def joinNodesLinks(nodes, links, feedback, linkIdFld='id', maxDist=1000, topK=0):
+    # maxDist 0 means no limit, if topK is set the table of the nearest links is also returned
+    nodeGeoms = nodes.geometry.to_numpy()
+    linkGeoms = links.geometry.to_numpy()
+
+    feedback.setPhase('nearest')
+    tree = shapely.STRtree(linkGeoms)
+    (nodeIdx, linkIdx), dist = tree.query_nearest(nodeGeoms, max_distance=maxDist or None, return_distance=True,
+                                                  all_matches=False)
+
+    linkIds = links[linkIdFld].to_numpy()
+    result = nodes.copy()
+    result['link_id'] = None
+    result.iloc[nodeIdx, result.columns.get_loc('link_id')] = linkIds[linkIdx]
+
+    # distance, snapped point and its position along the closest link
+    linkPos = shapely.line_locate_point(linkGeoms[linkIdx], nodeGeoms[nodeIdx])
+    snapPoints = shapely.line_interpolate_point(linkGeoms[linkIdx], linkPos)
+    for fldName, values in [('link_dist', dist), ('snap_x', shapely.get_x(snapPoints)),
+                            ('snap_y', shapely.get_y(snapPoints)), ('link_pos', linkPos)]:
+        result[fldName] = np.nan
+        result.iloc[nodeIdx, result.columns.get_loc(fldName)] = values
+    feedback.pushInfo('Num. of nodes without link: %s' % (len(nodes) - len(nodeIdx)))
+
+    nearTable = None
+    if topK > 0:
+        feedback.setPhase('top-k')
+        nearTable = nearestLinks(nodes, nodeGeoms, tree, linkIds, topK, maxDist)
+
+    feedback.setPhase(None)
+    return result, nearTable
+
+
+def endpointDegree(starts, ends, err):
+    # number of links with the start or the end vertex in the tolerance grid cell of each start vertex,
+    # the eight cells around are included, a closed link is counted once
+    startKeys = np.floor(starts / err).astype(np.int64)
+    endKeys = np.floor(ends / err).astype(np.int64)
+    isOpen = np.any(startKeys != endKeys, axis=1)
+    allKeys = np.ascontiguousarray(np.vstack([startKeys, endKeys[isOpen]])).view(np.dtype((np.void, 16))).ravel()
+    cellKeys, counts = np.unique(allKeys, return_counts=True)
+
+    degree = np.zeros(len(starts), dtype=np.int64)
+    for i in (-1, 0, 1):
+        for j in (-1, 0, 1):
+            keys = np.ascontiguousarray(startKeys + [i, j]).view(np.dtype((np.void, 16))).ravel()
+            pos = np.minimum(np.searchsorted(cellKeys, keys), len(cellKeys) - 1)
+            found = cellKeys[pos] == keys
+            degree[found] += counts[pos[found]]
+
+    return degree
+
+
+def joinLinksLanduse(landuse, links, feedback, err=0.001, typeFld='type', typeValues=('urml', 'urld'),
+                     luIdFld='gis_id', linkIdFld='gis_id'):
+    luGeoms = landuse.geometry.to_numpy()
+    linkGeoms = links.geometry.to_numpy()
+
+    feedback.setPhase('connections')
+    # start vertex of each link and number of links with an end point close to it
+    firstParts = shapely.get_geometry(linkGeoms, 0)
+    starts = shapely.get_point(firstParts, 0)
+    lastParts = shapely.get_geometry(linkGeoms, -1)
+    ends = shapely.get_point(lastParts, -1)
+    nConnected = endpointDegree(shapely.get_coordinates(starts), shapely.get_coordinates(ends), err)
+
+    feedback.setPhase('contains')
+    # land use polygons that contain the start vertex
+    linkIdx, luIdx = shapely.STRtree(luGeoms).query(starts, predicate='within')
+    isUrban = landuse[typeFld].isin(list(typeValues)).to_numpy()
+    keep = isUrban[luIdx] & (nConnected[linkIdx] <= 1)
+    linkIdx, luIdx = linkIdx[keep], luIdx[keep]
+
+    destIdList = {}
+    linkIds = links[linkIdFld].to_numpy()
+    for i, j in zip(luIdx.tolist(), linkIdx.tolist()):
+        destIdList.setdefault(i, []).append(linkIds[j])
+
+    luIds = landuse[luIdFld].tolist()
+    destCha = [None] * len(landuse)
+    for i, destIds in destIdList.items():
+        if len(destIds) > 1:
+            feedback.pushInfo('More than one segments start inside the polygon %s' % luIds[i])
+        else:
+            destCha[i] = destIds[0]
+
+    result = landuse.copy()
+    result['dest_cha'] = destCha
+    feedback.setPhase(None)
+    return result
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(description='OPTAIN tools without QGIS')
+    parser.add_argument('--quiet', action='store_true', help='do not print messages')
+    parser.add_argument('--timings', action='store_true', help='print the run time of each phase as json')
+    subparsers = parser.add_subparsers(dest='tool', required=True)
+
+    p = subparsers.add_parser('merge-small-features', help='merge small features based on the area')
+    p.add_argument('input')
+    p.add_argument('output')
+    p.add_argument('--area-lim', type=float, required=True)
+    p.add_argument('--name-fld', required=True)
+    p.add_argument('--group-fld', required=True)
+    p.add_argument('--phi-fld', required=True)
+    p.add_argument('--w-factor', type=float, required=True)
+    p.add_argument('--area-sweep', default='',
+                   help='other area limits separated by semicolon (as in QGIS) or comma, '
+                        'the merge continues from the smallest one')
+    p.add_argument('--merge-table', default=None,
+                   help='csv or parquet table with the merged feature of each input feature at each area limit')
+    p.add_argument('--avg-flds', default='', help='other numeric fields averaged by area, separated by semicolon or comma')
+    p.add_argument('--adjacency', default=None, help='npz adjacency table saved by find-common-edges')
+
+    p = subparsers.add_parser('clean-overlap', help='remove overlaps between polygons')
+    p.add_argument('input')
+    p.add_argument('output')
+    p.add_argument('--method', choices=['difference', 'overlay'], default='difference')
+    p.add_argument('--owner-rule', choices=['last', 'first', 'area', 'priority'], default='last',
+                   help='owner of the overlaps with the overlay method: last (as the pairwise difference) '
+                        'or first processed polygon, larger area or highest priority')
+    p.add_argument('--priority-fld', default=None, help='numeric field, the highest value owns the overlaps')
+    p.add_argument('--report', default=None, help='layer with the overlaps between each pair of polygons')
+
+    p = subparsers.add_parser('find-common-edges', help='common edges between adjacent polygons')
+    p.add_argument('layer1')
+    p.add_argument('layer2')
+    p.add_argument('output')
+    p.add_argument('--method', choices=['difference', 'arcs'], default='difference')
+    p.add_argument('--snap', type=float, default=0, help='snapping tolerance of the vertices with the arcs method')
+    p.add_argument('--adjacency', default=None,
+                   help='npz file to save the adjacency table, with the intersection length '
+                        'of the touching features')
+
+    p = subparsers.add_parser('join-nodes-links', help='add the id of the closest link to the nodes')
+    p.add_argument('nodes')
+    p.add_argument('links')
+    p.add_argument('output')
+    p.add_argument('--link-id-fld', default='id')
+    p.add_argument('--max-dist', type=float, default=1000, help='maximum distance, 0 for no limit')
+    p.add_argument('--top-k', type=int, default=1, help='number of nearest links saved in the --top-k-output table')
+    p.add_argument('--top-k-output', default=None, help='csv or parquet table with the nearest links of each node')
+
+    p = subparsers.add_parser('join-links-landuse', help='add the dest_cha field to the land use')
+    p.add_argument('landuse')
+    p.add_argument('links')
+    p.add_argument('output')
+    p.add_argument('--type-fld', default='type')
+    p.add_argument('--type-values', default='urml;urld', help='land use types separated by semicolon, as in QGIS')
+    p.add_argument('--lu-id-fld', default='gis_id')
+    p.add_argument('--link-id-fld', default='gis_id')
+
+    return parser
+
+
+def runTool(args, feedback):
+    # read the inputs, run the tool and write the output
+    feedback.setPhase('read')
+
+    if args.tool == 'merge-small-features':
+        areaSweep = [float(a) for a in splitList(args.area_sweep)]
+        avgFlds = splitList(args.avg_flds)
+        result, mergeTable = mergeSmallFeatures(readLayer(args.input), args.area_lim, args.name_fld,
+                                                args.group_fld, args.phi_fld, args.w_factor, feedback, areaSweep,
+                                                avgFlds, args.adjacency, bool(args.merge_table))
+        if args.merge_table:
+            if args.merge_table.lower().endswith('.parquet'):
+                mergeTable.to_parquet(args.merge_table)
+            else:
+                mergeTable.to_csv(args.merge_table, index=False)
+    elif args.tool == 'clean-overlap':
+        if args.method == 'overlay':
+            if args.owner_rule == 'priority' and not args.priority_fld:
+                raise SystemExit('--priority-fld is required by the priority owner rule')
+            result, reportGdf = cleanOverlapOverlay(readLayer(args.input), feedback, args.owner_rule,
+                                                    args.priority_fld, bool(args.report))
+        else:
+            result, reportGdf = cleanOverlap(readLayer(args.input), feedback, bool(args.report))
+
+        if reportGdf is not None:
+            feedback.pushInfo('Num. of overlaps: %s' % len(reportGdf))
+            writeLayer(reportGdf, args.report)
+    elif args.tool == 'find-common-edges':
+        gdf1 = readLayer(args.layer1)
+        sameLayer = args.layer1 == args.layer2
+        gdf2 = gdf1 if sameLayer else readLayer(args.layer2)
+        if args.adjacency:
+            feedback.setPhase('adjacency')
+            # keyed by the content of the inputs, so that other tools can check it is up to date
+            hashA = layerHash(gdf1)
+            hashB = hashA if sameLayer else layerHash(gdf2)
+            fidA, fidB, lengths = adjacencyPairs(gdf1, gdf2, sameLayer)
+            saveAdjacency(args.adjacency, fidA, fidB, lengths, hashA, hashB)
+
+        if args.method == 'arcs':
+            result = findSharedArcs(gdf1, gdf2, feedback, args.snap, sameLayer)
+        else:
+            result = findCommonEdges(gdf1, gdf2, feedback)
+    elif args.tool == 'join-nodes-links':
+        topK = args.top_k if args.top_k_output else 0
+        if topK > 0 and args.max_dist <= 0:
+            raise SystemExit('--top-k needs a maximum distance')
+        result, nearTable = joinNodesLinks(readLayer(args.nodes), readLayer(args.links), feedback,
+                                           args.link_id_fld, args.max_dist, topK)
+        if args.top_k_output:
+            if args.top_k_output.lower().endswith('.parquet'):
+                nearTable.to_parquet(args.top_k_output)
+            else:
+                nearTable.to_csv(args.top_k_output, index=False)
+    else:
+        typeValues = splitList(args.type_values)
+        result = joinLinksLanduse(readLayer(args.landuse), readLayer(args.links), feedback, 0.001, args.type_fld,
+                                  typeValues, args.lu_id_fld, args.link_id_fld)
+
+    feedback.setPhase('write')
+    writeLayer(result, args.output)
+    feedback.setPhase(None)
+    return result
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    importLibs()
+    feedback = Feedback(args.quiet)
+    runTool(args, feedback)
+
+    if args.timings:
+        print(json.dumps(feedback.timings), file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+    tiled_processing.py
+    ---------------------
+    Date                 : October 2026
+    Copyright         : (C) 2026 by Enrico A. Chiaradia
+    Email                : enrico.chiaradia@unimi.it
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+__author__ = 'Enrico A. Chiaradia'
+__date__ = 'October 2026'
+__copyright__ = '(C) 2026, Enrico A. Chiaradia'
+
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QCoreApplication
+from qgis import processing
+
+from qgis.core import (QgsApplication,
+                       QgsCoordinateTransformContext,
+                       QgsFeature,
+                       QgsFeatureRequest,
+                       QgsFeatureSink,
+                       QgsFields,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingException,
+                       QgsProcessingUtils,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterString,
+                       QgsProcessing,
+                       QgsProcessingParameterFeatureSink, QgsVectorLayer,
+                       QgsProcessingParameterNumber,
+                       QgsRectangle, QgsVectorFileWriter,
+                       QgsWkbTypes)
+
+pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
+
+
+class TiledProcessing(QgsProcessingAlgorithm):
+    INPUT = 'INPUT'
+    ALGORITHM = 'ALGORITHM'
+    ALG_PARAMS = 'ALG_PARAMS'
+    TILE_SIZE = 'TILE_SIZE'
+    HALO = 'HALO'
+    N_WORKERS = 'N_WORKERS'
+    OUTPUT = 'OUTPUT'
+
+    # algorithm id, name of the input parameters and output geometry type
+    ALGORITHMS = [('script:mergesmallfeatures', ['INPUT'], QgsWkbTypes.MultiPolygon),
+                  ('script:cleanoverlap', ['LAYER1'], QgsWkbTypes.MultiPolygon),
+                  ('script:findcommonedges', ['LAYER1', 'LAYER2'], QgsWkbTypes.LineString)]
+
+    def tr(self, string):
+        """
+        Returns a translatable string with the self.tr() function.
+        """
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return TiledProcessing()
+
+    def icon(self):
+        return QgsApplication.getThemeIcon("/algorithms/mAlgorithmDissolve.svg")
+
+    def svgIconPath(self):
+        return QgsApplication.iconPath("/algorithms/mAlgorithmDissolve.svg")
+
+    def group(self):
+        return self.tr('Optain tools')
+
+    def groupId(self):
+        return 'optaintools'
+
+    def __init__(self):
+        super().__init__()
+
+    def initAlgorithm(self, config=None):
+
+        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT,
+                                                              self.tr('Input layer'), [QgsProcessing.TypeVectorPolygon]))
+
+        self.addParameter(QgsProcessingParameterEnum(self.ALGORITHM, self.tr('Algorithm'),
+                                                     [self.tr('Merge small features'),
+                                                      self.tr('Clear overlapping features'),
+                                                      self.tr('Find common edges')], False, 0))
+
+        self.addParameter(QgsProcessingParameterString(self.ALG_PARAMS,
+                                                       self.tr('Algorithm parameters (KEY=VALUE;KEY=VALUE)'),
+                                                       '', False, True))
+
+        self.addParameter(
+            QgsProcessingParameterNumber(self.TILE_SIZE, self.tr('Tile size'), QgsProcessingParameterNumber.Double,
+                                         None, False, 0))
+
+        self.addParameter(
+            QgsProcessingParameterNumber(self.HALO, self.tr('Halo'), QgsProcessingParameterNumber.Double,
+                                         0, False, 0))
+
+        self.addParameter(QgsProcessingParameterNumber(self.N_WORKERS, self.tr('Number of parallel workers'),
+                                                       QgsProcessingParameterNumber.Integer, 1, False, 1))
+
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Stitched')))
+
+    def name(self):
+        return 'tiledprocessing'
+
+    def displayName(self):
+        return self.tr('Tiled processing')
+
+    def shortHelpString(self):
+        helpStr = """
+    					The algorithm splits the input layer in tiles and runs the selected algorithm on each tile.
+    					<b>Parameters:</b>
+    					Input layer: the polygon layer to process [INPUT]
+    					Algorithm: the algorithm to run on each tile [ALGORITHM]
+    					Algorithm parameters: the other parameters of the algorithm, i.e. AREA_LIM=5000;NAME_FLD=name [ALG_PARAMS]
+    					Tile size: the side of the square tiles in map units [TILE_SIZE]
+    					Halo: the width of the border added to each tile in map units [HALO]
+    					Number of parallel workers: the number of qgis_process instances to run at the same time [N_WORKERS]
+    					<b>Note:</b>
+    					an output feature is kept only by the tile that contains its point on surface.
+    					The halo should be larger than the distance a feature can be influenced from,
+    					otherwise the results along the tile borders can differ from the untiled run.
+    					"""
+
+        return self.tr(helpStr)
+
+    def parseAlgParams(self, paramString):
+        # KEY=VALUE;KEY=VALUE -> {KEY: VALUE}
+        algParams = {}
+        for item in paramString.split(';'):
+            if not item.strip():
+                continue
+
+            if '=' not in item:
+                raise QgsProcessingException(self.tr('Wrong algorithm parameter: %s') % item)
+
+            key, value = item.split('=', 1)
+            algParams[key.strip()] = value.strip()
+
+        return algParams
+
+    def getTiles(self, inLayer, tileSize):
+        # return the core rectangles of the tiles that intersect at least one feature
+        extent = inLayer.sourceExtent()
+        tileKeys = set()
+        for aFeat in inLayer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            bbox = aFeat.geometry().boundingBox()
+            ix0 = int((bbox.xMinimum() - extent.xMinimum()) // tileSize)
+            ix1 = int((bbox.xMaximum() - extent.xMinimum()) // tileSize)
+            iy0 = int((bbox.yMinimum() - extent.yMinimum()) // tileSize)
+            iy1 = int((bbox.yMaximum() - extent.yMinimum()) // tileSize)
+            for ix in range(ix0, ix1 + 1):
+                for iy in range(iy0, iy1 + 1):
+                    tileKeys.add((ix, iy))
+
+        tiles = []
+        for ix, iy in sorted(tileKeys):
+            tiles.append(((ix, iy), QgsRectangle(extent.xMinimum() + ix * tileSize,
+                                                 extent.yMinimum() + iy * tileSize,
+                                                 extent.xMinimum() + (ix + 1) * tileSize,
+                                                 extent.yMinimum() + (iy + 1) * tileSize)))
+
+        return tiles
+
+    def isOwner(self, core, geom):
+        # half-open test so that each point belongs to exactly one tile
+        # null and empty geometries have no point and are handled by the caller
+        point = geom.pointOnSurface().asPoint()
+        return (core.xMinimum() <= point.x() < core.xMaximum()) and \
+               (core.yMinimum() <= point.y() < core.yMaximum())
+
+    def writeTile(self, inLayer, rect, fileName):
+        # save the features that intersect the tile (with halo) to a geopackage
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'GPKG'
+        writer = QgsVectorFileWriter.create(fileName, inLayer.fields(), inLayer.wkbType(), inLayer.sourceCrs(),
+                                            QgsCoordinateTransformContext(), options)
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            raise QgsProcessingException(self.tr('Could not write tile %s: %s') % (fileName, writer.errorMessage()))
+
+        nFeat = 0
+        for aFeat in inLayer.getFeatures(QgsFeatureRequest().setFilterRect(rect)):
+            writer.addFeature(aFeat, QgsFeatureSink.FastInsert)
+            nFeat += 1
+
+        del writer
+        return nFeat
+
+    def findQgisProcess(self):
+        # qgis_process executable, None if not available
+        for exeName in ['qgis_process', 'qgis_process-qgis.bat', 'qgis_process-qgis-ltr.bat']:
+            exePath = os.path.join(QgsApplication.prefixPath(), 'bin', exeName)
+            if os.path.exists(exePath):
+                return exePath
+
+            exePath = shutil.which(exeName)
+            if exePath:
+                return exePath
+
+        return None
+
+    def runTileProcess(self, exePath, algId, tileParams):
+        # run the algorithm in a separate qgis_process instance
+        cmd = [exePath, 'run', algId] + ['--%s=%s' % (k, v) for k, v in tileParams.items()]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        return proc.returncode, proc.stdout
+
+    def processAlgorithm(self, parameters, context, feedback):
+        inLayer = self.parameterAsSource(parameters, self.INPUT, context)
+        if inLayer is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        algId, inputNames, outWkbType = self.ALGORITHMS[self.parameterAsEnum(parameters, self.ALGORITHM, context)]
+        algParams = self.parseAlgParams(self.parameterAsString(parameters, self.ALG_PARAMS, context))
+        tileSize = self.parameterAsDouble(parameters, self.TILE_SIZE, context)
+        halo = self.parameterAsDouble(parameters, self.HALO, context)
+        nWorkers = self.parameterAsInt(parameters, self.N_WORKERS, context)
+
+        if tileSize <= 0:
+            raise QgsProcessingException(self.tr('Tile size must be greater than zero'))
+
+        tiles = self.getTiles(inLayer, tileSize)
+        feedback.pushInfo(self.tr('Num. of tiles to be processed: %s') % len(tiles))
+
+        # prepare the input of each tile
+        tileList = []
+        for (ix, iy), core in tiles:
+            if feedback.isCanceled():
+                break
+
+            inFile = QgsProcessingUtils.generateTempFilename('tile_%s_%s.gpkg' % (ix, iy))
+            if self.writeTile(inLayer, core.buffered(halo), inFile) == 0:
+                continue
+
+            tileParams = dict(algParams)
+            for inputName in inputNames:
+                tileParams[inputName] = inFile
+
+            tileParams['OUTPUT'] = QgsProcessingUtils.generateTempFilename('tile_%s_%s_out.gpkg' % (ix, iy))
+            tileList.append((core, tileParams))
+
+        exePath = None
+        if nWorkers > 1:
+            exePath = self.findQgisProcess()
+            if exePath is None:
+                feedback.pushInfo(self.tr('qgis_process not found, tiles will be processed sequentially'))
+
+        # run the algorithm on each tile
+        processCount = 0
+        if exePath:
+            with ThreadPoolExecutor(max_workers=nWorkers) as executor:
+                futureList = [executor.submit(self.runTileProcess, exePath, algId, tileParams)
+                              for core, tileParams in tileList]
+                for future, (core, tileParams) in zip(futureList, tileList):
+                    if feedback.isCanceled():
+                        future.cancel()
+                        continue
+
+                    returnCode, log = future.result()
+                    if returnCode != 0:
+                        raise QgsProcessingException(self.tr('Tile %s failed:\n%s') % (tileParams['OUTPUT'], log))
+
+                    processCount += 1
+                    feedback.setProgress(100 * float(processCount) / len(tileList))
+        else:
+            for core, tileParams in tileList:
+                if feedback.isCanceled():
+                    break
+
+                processing.run(algId, tileParams, context=context, feedback=feedback, is_child_algorithm=True)
+                processCount += 1
+                feedback.setProgress(100 * float(processCount) / len(tileList))
+
+        # the output has the fields of the algorithm output (i.e. left_fid, right_fid, length of the shared arcs)
+        # without the primary key, that is repeated when a feature is owned by more than one tile
+        outFields = inLayer.fields()
+        pkName = None
+        if tileList:
+            firstLayer = QgsVectorLayer(tileList[0][1]['OUTPUT'], 'tile', 'ogr')
+            outFields = QgsFields()
+            pkIdxList = firstLayer.primaryKeyAttributes()
+            for idx, fld in enumerate(firstLayer.fields()):
+                if idx not in pkIdxList:
+                    outFields.append(fld)
+                elif inLayer.fields().indexOf(fld.name()) >= 0:
+                    # the primary key keeps the id of the input feature, so it shows the features owned twice
+                    pkName = fld.name()
+
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                               outFields, outWkbType, inLayer.sourceCrs())
+
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+        # stitch the owned features of each tile
+        coreList = [core for core, tileParams in tileList]
+        pkSet = set()
+        seenPkSet = set()
+        nDuplicate = 0
+        nLost = 0
+        nNull = 0
+        for core, tileParams in tileList:
+            if feedback.isCanceled():
+                break
+
+            outLayer = QgsVectorLayer(tileParams['OUTPUT'], 'tile', 'ogr')
+            featList = []
+            for aFeat in outLayer.getFeatures():
+                geom = aFeat.geometry()
+                pkValue = aFeat[pkName] if pkName is not None else None
+                if pkName is not None:
+                    seenPkSet.add(pkValue)
+
+                if geom.isNull() or geom.isEmpty():
+                    # i.e. a polygon completely covered by the planar overlay: without the input id
+                    # it cannot be assigned to a tile, with the id it is kept by the first tile that returns it
+                    if pkName is None:
+                        nNull += 1
+                        continue
+                    if pkValue in pkSet:
+                        continue
+                elif not self.isOwner(core, geom):
+                    # without the input id, a feature whose point is in no tile is lost
+                    if pkName is None and not any(self.isOwner(c, geom) for c in coreList):
+                        nLost += 1
+                    continue
+
+                if pkName is not None:
+                    if pkValue in pkSet:
+                        nDuplicate += 1
+                    pkSet.add(pkValue)
+
+                newFeat = QgsFeature(outFields)
+                newFeat.setAttributes([aFeat[fld.name()] for fld in outFields])
+                newFeat.setGeometry(aFeat.geometry())
+                featList.append(newFeat)
+
+            if not sink.addFeatures(featList, QgsFeatureSink.FastInsert):
+                feedback.reportError(self.tr('Could not write the features of tile %s') % tileParams['OUTPUT'])
+
+        del sink
+
+        if pkName is not None:
+            # the input features returned by some tile but kept by none
+            nLost = len(seenPkSet - pkSet)
+
+        if nDuplicate:
+            feedback.reportError(self.tr('%s features are owned by more than one tile, '
+                                         'increase the halo or the tile size') % nDuplicate)
+        if nLost:
+            feedback.reportError(self.tr('%s features are not owned by any tile and are missing in the output, '
+                                         'increase the halo or the tile size') % nLost)
+        if nNull:
+            feedback.reportError(self.tr('%s features with empty geometry are skipped, '
+                                         'they cannot be assigned to a tile') % nNull)
+
+        return {self.OUTPUT: dest_id}
@@ -2,10 +2,11 @@
 # add this script as python action in the properties of the vector layer in your QGIS project
 # than use identify feature tool and click on the new action under the actions list
 
-import matplotlib
-matplotlib.use('qtagg')
-import matplotlib.pyplot as plt
-import pandas as pd
+import os
+import sys
+import tempfile
+
+from qgis.core import QgsProject
 
 # file_name is the name of the file that contains the time serie
 # the file must be in CSV format and must contain two column: timestamp, rec_value
@@ -16,10 +17,50 @@ import pandas as pd
 # the layer must have a column called FILE with the absolute path to the CSV file
 file_name  = r'[%FILE%]'
 
-# open the file with pandas
-df = pd.read_csv(file_name, sep=';')
-#print(df)
-#df.plot( 'timestamp' , 'rec_value' )
-plt.plot(df['timestamp'],df['rec_value'])
-plt.title('data from '+file_name)
-plt.show()
\ No newline at end of file
+# when compare_selected is True and some features of the layer are selected,
+# the series of the clicked feature and of all the selected features are plotted together on the same time axis
+compare_selected = True
+layer_id = r'[% @layer_id %]'
+file_field = 'FILE'
+max_workers = 8
+
+# optional time window in the form aaaa-mm-day, leave empty to plot the whole serie
+# the window is replaced by the values of the fields window_fields of the clicked feature, if the layer has them,
+# and can be changed in a small dialog when ask_window is True
+date_from = ''
+date_to = ''
+window_fields = ['DATE_FROM', 'DATE_TO']
+ask_window = False
+feature_id = int(r'[% $id %]')
+
+# folder of plot_server.py, the default is the folder of the QGIS project
+plot_dir = QgsProject.instance().homePath()
+
+# each CSV is converted once to a pair of .npy files (timestamps and values) in the cache folder
+# the least recently used files are deleted when the folder is larger than cache_max_mb
+cache_dir = os.path.join(tempfile.gettempdir(), 'open_plot_cache')
+cache_max_mb = 2000
+
+# the plotted line has at most about two points (min and max) for each pixel of the axes width
+points_per_pixel = 2
+
+
+# plot_server is imported only at the first click, next clicks reuse the loaded module and the figure window
+if plot_dir not in sys.path:
+    sys.path.append(plot_dir)
+
+import plot_server
+
+# the clicked feature is always plotted, with the selected ones
+file_list = [file_name]
+if compare_selected:
+    file_list += plot_server.selectedFiles(layer_id, file_field)
+
+window = plot_server.attributeWindow(layer_id, feature_id, *window_fields)
+window = [w or d for w, d in zip(window, [date_from, date_to])]
+if ask_window:
+    window = plot_server.askWindow(*window)
+
+if window is not None:
+    plot_server.getServer().plot(file_list, window[0], window[1], cache_dir, cache_max_mb, points_per_pixel,
+                                 max_workers)
@@ -0,0 +1,436 @@
+# USAGE:
+# plot server used by open_plot.py
+# the module is imported once by the QGIS python interpreter and stays in memory,
+# so matplotlib, numpy and pandas are loaded only at the first click
+# and all the plots are drawn in the same figure window
+
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import matplotlib
+matplotlib.use('qtagg')
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from qgis.core import QgsProject
+from qgis.PyQt.QtWidgets import QDialog, QDialogButtonBox, QFormLayout, QLineEdit
+
+# the CSV index has the byte offset of one row every index_step rows
+index_step = 10000
+# rows parsed at a time when a CSV is read, the memory used does not depend on the length of the file
+chunk_rows = 100000
+block_size = 16 * 1024 * 1024
+
+
+def cacheKey(file_name):
+    # the cached files are renewed when the CSV changes
+    stat = os.stat(file_name)
+    key = '%s|%s|%s' % (os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def evictCache(cache_dir, cache_max_mb, keep_keys=()):
+    # delete the least recently used pairs until the folder is smaller than the limit
+    # the pairs of keep_keys are in use and are never deleted, even if alone they are larger than the limit
+    pairs = {}
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+            path = os.path.join(cache_dir, name)
+            key = name[:-len('_t.npy')]
+            stat = os.stat(path)
+            size, used = pairs.get(key, (0, 0))
+            pairs[key] = (size + stat.st_size, max(used, stat.st_mtime))
+
+    total = sum(size for size, used in pairs.values())
+    for key, (size, used) in sorted(pairs.items(), key=lambda item: item[1][1]):
+        if total <= cache_max_mb * 1024 * 1024:
+            break
+        if key in keep_keys:
+            continue
+
+        for suffix in ['_t.npy', '_v.npy']:
+            try:
+                os.remove(os.path.join(cache_dir, key + suffix))
+            except OSError:
+                pass
+
+        total -= size
+
+
+def tempName(folder):
+    # unique temporary file, so that two threads converting the same CSV never write the same file
+    fd, path = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    os.close(fd)
+    return path
+
+
+def toTime(text):
+    # datetime64 of a date in the form aaaa-mm-day (a time can follow)
+    return pd.Timestamp(text).to_datetime64().astype('datetime64[ns]')
+
+
+def indexFile(file_name, cache_dir):
+    # the index is saved next to the CSV, or in the cache folder if the CSV folder is read only
+    path = file_name + '.index.npz'
+    if os.access(os.path.dirname(os.path.abspath(path)), os.W_OK):
+        return path
+
+    return os.path.join(cache_dir, cacheKey(file_name) + '_index.npz')
+
+
+def buildIndex(file_name):
+    # byte offset and timestamp of one row every index_step rows, without loading the whole file
+    size = os.path.getsize(file_name)
+    offsets = []
+    n_rows = 0
+    with open(file_name, 'rb') as f:
+        header = f.readline()
+        columns = header.decode('utf-8').strip().split(';')
+        # start of the line not yet ended, and the last byte of the previous block to find \r\n lines
+        line_start = len(header)
+        block_offset = len(header)
+        last_byte = b'\n'
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+
+            buffer = np.frombuffer(last_byte + block, dtype=np.uint8)
+            ends = block_offset + np.flatnonzero(buffer[1:] == 10)
+            starts = np.concatenate([[line_start], ends[:-1] + 1]).astype(np.int64)
+            # blank lines are skipped by pandas, so they are not rows
+            lengths = ends - starts
+            blank = (lengths == 0) | ((lengths == 1) & (buffer[np.maximum(starts - block_offset + 1, 0)] == 13))
+            starts = starts[~blank] if len(ends) else starts[:0]
+            # the rows with number multiple of index_step
+            first = (-n_rows) % index_step
+            offsets.append(starts[first::index_step])
+            n_rows += len(starts)
+            if len(ends):
+                line_start = int(ends[-1]) + 1
+            block_offset += len(block)
+            last_byte = block[-1:]
+
+        # the last line without a newline at the end
+        f.seek(line_start)
+        if f.read().strip():
+            if n_rows % index_step == 0:
+                offsets.append(np.array([line_start], dtype=np.int64))
+            n_rows += 1
+
+        offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+        pos = columns.index('timestamp')
+        times = np.empty(len(offsets), dtype='datetime64[ns]')
+        for i, offset in enumerate(offsets):
+            f.seek(offset)
+            times[i] = toTime(f.readline().decode('utf-8').split(';')[pos])
+
+    rows = np.arange(len(offsets), dtype=np.int64) * index_step
+    return {'columns': np.array(columns), 'offsets': offsets, 'times': times, 'rows': rows, 'n_rows': n_rows}
+
+
+def loadIndex(file_name, cache_dir):
+    # sparse timestamp to byte offset index of the CSV, renewed when the CSV changes
+    path = indexFile(file_name, cache_dir)
+    key = cacheKey(file_name)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            if str(data['key']) == key:
+                return {name: data[name] for name in ['columns', 'offsets', 'times', 'rows', 'n_rows']}
+
+    index = buildIndex(file_name)
+    tmp_path = tempName(os.path.dirname(os.path.abspath(path)))
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, key=key, **index)
+    os.replace(tmp_path, path)
+    return index
+
+
+def readRows(file_name, index, offset, n_rows):
+    # timestamps and values of n_rows rows from the byte offset, chunk_rows at a time
+    with open(file_name, 'rb') as f:
+        f.seek(offset)
+        reader = pd.read_csv(f, sep=';', header=None, names=list(index['columns']), nrows=n_rows,
+                             chunksize=chunk_rows)
+        for chunk in reader:
+            yield (pd.to_datetime(chunk['timestamp']).to_numpy(dtype='datetime64[ns]'),
+                   chunk['rec_value'].to_numpy(dtype=np.float64))
+
+
+def cacheFiles(file_name, cache_dir):
+    key = cacheKey(file_name)
+    return os.path.join(cache_dir, key + '_t.npy'), os.path.join(cache_dir, key + '_v.npy')
+
+
+def loadSerie(file_name, cache_dir):
+    # timestamps (datetime64) and values (float) of the time serie, memory mapped from the cache
+    os.makedirs(cache_dir, exist_ok=True)
+    time_file, value_file = cacheFiles(file_name, cache_dir)
+
+    if not (os.path.exists(time_file) and os.path.exists(value_file)):
+        index = loadIndex(file_name, cache_dir)
+        n_rows = int(index['n_rows'])
+        # the CSV is copied in chunks to the memory mapped files, so the memory does not depend on its length
+        # write to a temporary name first, so that an interrupted conversion is never used
+        time_tmp = tempName(cache_dir)
+        value_tmp = tempName(cache_dir)
+        time_map = np.lib.format.open_memmap(time_tmp, mode='w+', dtype='datetime64[ns]', shape=(n_rows,))
+        value_map = np.lib.format.open_memmap(value_tmp, mode='w+', dtype=np.float64, shape=(n_rows,))
+        k = 0
+        if n_rows:
+            for timestamps, values in readRows(file_name, index, index['offsets'][0], n_rows):
+                time_map[k:k + len(timestamps)] = timestamps
+                value_map[k:k + len(values)] = values
+                k += len(timestamps)
+
+        time_map.flush()
+        value_map.flush()
+        del time_map, value_map
+        if k != n_rows:
+            # never cache rows that were not read, they would be zero timestamps
+            os.remove(time_tmp)
+            os.remove(value_tmp)
+            raise ValueError('%s: %s rows indexed, %s rows read' % (file_name, n_rows, k))
+
+        os.replace(time_tmp, time_file)
+        os.replace(value_tmp, value_file)
+    else:
+        # the modification time marks the last use
+        os.utime(time_file)
+        os.utime(value_file)
+
+    return np.load(time_file, mmap_mode='r'), np.load(value_file, mmap_mode='r')
+
+
+def readWindow(file_name, date_from, date_to, cache_dir):
+    # read only the byte range of the CSV between the index rows around the window
+    index = loadIndex(file_name, cache_dir)
+    times = index['times']
+    n_rows = int(index['n_rows'])
+    if not n_rows:
+        return np.zeros(0, dtype='datetime64[ns]'), np.zeros(0)
+
+    t0 = toTime(date_from) if date_from else None
+    t1 = toTime(date_to) if date_to else None
+    if (t0 is not None) and (t1 is not None) and (t0 > t1):
+        return np.zeros(0, dtype='datetime64[ns]'), np.zeros(0)
+    first = 0
+    if t0 is not None:
+        first = max(int(np.searchsorted(times, t0, 'right')) - 1, 0)
+
+    last = len(times)
+    if t1 is not None:
+        last = int(np.searchsorted(times, t1, 'right'))
+
+    end_row = index['rows'][last] if last < len(times) else n_rows
+    n_read = int(end_row - index['rows'][first])
+    out_t = np.empty(n_read, dtype='datetime64[ns]')
+    out_v = np.empty(n_read, dtype=np.float64)
+    k = 0
+    for timestamps, values in readRows(file_name, index, index['offsets'][first], n_read):
+        inside = np.ones(len(timestamps), dtype=bool)
+        if t0 is not None:
+            inside &= timestamps >= t0
+        if t1 is not None:
+            inside &= timestamps <= t1
+
+        n = int(inside.sum())
+        out_t[k:k + n] = timestamps[inside]
+        out_v[k:k + n] = values[inside]
+        k += n
+
+    return out_t[:k], out_v[:k]
+
+
+def selectedFiles(layer_id, file_field):
+    # CSV files of the selected features of the layer
+    layer = QgsProject.instance().mapLayer(layer_id)
+    if layer is None:
+        return []
+
+    return [str(feat[file_field]) for feat in layer.selectedFeatures() if feat[file_field]]
+
+
+def attributeWindow(layer_id, feature_id, from_field, to_field):
+    # time window from the attributes of the clicked feature, empty if the layer has not the fields
+    layer = QgsProject.instance().mapLayer(layer_id)
+    window = ['', '']
+    if layer is None:
+        return window
+
+    feat = layer.getFeature(feature_id)
+    for i, field in enumerate([from_field, to_field]):
+        if layer.fields().indexOf(field) < 0 or not feat[field]:
+            continue
+
+        value = feat[field]
+        # date and datetime fields are returned as QDate and QDateTime
+        if hasattr(value, 'toPyDateTime'):
+            value = value.toPyDateTime()
+        elif hasattr(value, 'toPyDate'):
+            value = value.toPyDate()
+
+        window[i] = str(value)
+
+    return window
+
+
+def askWindow(date_from, date_to):
+    # small dialog to change the time window, None if cancelled
+    dialog = QDialog()
+    dialog.setWindowTitle('Time window')
+    layout = QFormLayout(dialog)
+    edits = []
+    for label, value in [('From', date_from), ('To', date_to)]:
+        edit = QLineEdit(value)
+        edit.setPlaceholderText('aaaa-mm-day, empty for no limit')
+        layout.addRow(label, edit)
+        edits.append(edit)
+
+    buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+    buttons.accepted.connect(dialog.accept)
+    buttons.rejected.connect(dialog.reject)
+    layout.addRow(buttons)
+    if not dialog.exec_():
+        return None
+
+    return [edit.text().strip() for edit in edits]
+
+
+def loadWindow(file_name, date_from, date_to, cache_dir):
+    # the whole serie comes from the memory mapped cache, a time window is sliced from the cache if present
+    # or is read directly from the CSV
+    if not (date_from or date_to):
+        return loadSerie(file_name, cache_dir)
+
+    time_file, value_file = cacheFiles(file_name, cache_dir)
+    if not (os.path.exists(time_file) and os.path.exists(value_file)):
+        return readWindow(file_name, date_from, date_to, cache_dir)
+
+    timestamps, values = loadSerie(file_name, cache_dir)
+    i0, i1 = 0, len(timestamps)
+    if date_from:
+        i0 = int(np.searchsorted(timestamps, toTime(date_from)))
+    if date_to:
+        i1 = int(np.searchsorted(timestamps, toTime(date_to), 'right'))
+
+    return timestamps[i0:i1], values[i0:i1]
+
+
+def decimateMinMax(values, i0, i1, n_bins):
+    # indexes of the first, the last, the minimum and the maximum value of each bin between i0 and i1
+    n = i1 - i0
+    if n <= 2 * n_bins:
+        return np.arange(i0, i1)
+
+    bin_size = -(-n // n_bins)
+    n_full = (n // bin_size) * bin_size
+    bins = np.asarray(values[i0:i0 + n_full]).reshape(-1, bin_size)
+    offsets = i0 + np.arange(0, n_full, bin_size)
+    index_list = [offsets + np.argmin(bins, axis=1), offsets + np.argmax(bins, axis=1), [i0, i1 - 1]]
+    if n_full < n:
+        last = np.asarray(values[i0 + n_full:i1])
+        index_list.append([i0 + n_full + np.argmin(last), i0 + n_full + np.argmax(last)])
+
+    return np.unique(np.concatenate(index_list))
+
+
+def visibleRange(ax, timestamps):
+    # indexes of the points inside the x limits of the axes, plus one on each side
+    x_min, x_max = [np.datetime64(mdates.num2date(x).replace(tzinfo=None), 'ns') for x in ax.get_xlim()]
+    i0 = max(int(np.searchsorted(timestamps, x_min)) - 1, 0)
+    i1 = min(int(np.searchsorted(timestamps, x_max, 'right')) + 1, len(timestamps))
+    return i0, i1
+
+
+def plotDecimated(ax, timestamps, values, label=None, points_per_pixel=2):
+    # plot a reduced line and decimate again from the full resolution data when the view changes
+    n_bins = max(int(ax.bbox.width * points_per_pixel / 2), 1)
+    idx = decimateMinMax(values, 0, len(values), n_bins)
+    line, = ax.plot(timestamps[idx], values[idx], label=label)
+
+    def update(event=None):
+        n_bins = max(int(ax.bbox.width * points_per_pixel / 2), 1)
+        i0, i1 = visibleRange(ax, timestamps)
+        idx = decimateMinMax(values, i0, i1, n_bins)
+        line.set_data(timestamps[idx], values[idx])
+        ax.figure.canvas.draw_idle()
+
+    ax.callbacks.connect('xlim_changed', update)
+    return line, ax.figure.canvas.mpl_connect('resize_event', update)
+
+
+class PlotServer:
+    # keeps one figure window and redraws it at each request
+
+    def __init__(self):
+        self.fig = None
+        self.resize_ids = []
+
+    def getAxes(self):
+        # reuse the window if the user did not close it
+        if self.fig is None or not plt.fignum_exists(self.fig.number):
+            self.fig = plt.figure()
+            self.resize_ids = []
+
+        for cid in self.resize_ids:
+            self.fig.canvas.mpl_disconnect(cid)
+
+        self.resize_ids = []
+        self.fig.clear()
+        return self.fig.add_subplot()
+
+    def plot(self, file_list, date_from='', date_to='', cache_dir=None, cache_max_mb=2000,
+             points_per_pixel=2, max_workers=8):
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(), 'open_plot_cache')
+
+        if date_from and date_to and toTime(date_from) > toTime(date_to):
+            raise ValueError('The time window starts (%s) after it ends (%s)' % (date_from, date_to))
+
+        # each CSV once, even if more features point to it
+        file_list = list(dict.fromkeys(file_list))
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # open the files from the cache, the CSV files not yet converted are read at the same time
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            series = list(executor.map(lambda f: loadWindow(f, date_from, date_to, cache_dir), file_list))
+
+        # the cache is reduced only when all the loads are finished, the files just loaded are kept
+        evictCache(cache_dir, cache_max_mb, [cacheKey(f) for f in file_list])
+
+        ax = self.getAxes()
+        for f, (timestamps, values) in zip(file_list, series):
+            line, cid = plotDecimated(ax, timestamps, values, os.path.basename(f), points_per_pixel)
+            self.resize_ids.append(cid)
+
+        if len(file_list) == 1:
+            ax.set_title('data from '+file_list[0])
+        else:
+            ax.set_title('data from %s features' % len(file_list))
+            ax.legend()
+
+        self.fig.canvas.draw_idle()
+        self.fig.show()
+        # bring the reused window in front of QGIS
+        window = getattr(self.fig.canvas.manager, 'window', None)
+        if window is not None:
+            window.raise_()
+            window.activateWindow()
+
+        return self.fig
+
+
+_server = None
+
+
+def getServer():
+    # the same server is returned for the whole QGIS session
+    global _server
+    if _server is None:
+        _server = PlotServer()
+
+    return _server